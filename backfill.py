@@ -0,0 +1,273 @@
+import gzip
+import hashlib
+import logging as log
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+
+import pymongo
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+
+import metrics
+from data_aggregator import clean_articles
+from digest_utils import refresh_digests
+from met_office_utils import flatten_forecast, get_timesteps_collection
+from mongo_utils import get_collection
+from news_utils import get_articles_collection, save_news_checkpoint
+from schema_utils import slim_tweet
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+BATCH_SIZE = 1000
+WORKERS = 4
+PROGRESS_EVERY = 10
+DUPLICATE_KEY_ERROR = 11000
+
+
+def read_jsonl(paths):
+    """
+    Records of JSONL/NDJSON files, gzipped if the name ends in .gz. Lines are
+    parsed with bson.json_util so mongoexport dumps ($date, $oid) load too.
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json_util.loads(line)
+                except ValueError:
+                    log.warning(f"{path}:{line_number} is not valid JSON, skipped")
+
+
+class BulkWriter:
+    """
+    Batches operations per collection and sends each full batch as an
+    unordered bulk_write on a small thread pool, so parsing the next batch
+    overlaps with writing the last. Inserts of documents already stored are
+    counted as duplicates rather than failing the load.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, workers=WORKERS):
+        self.batch_size = batch_size
+        self.max_pending = workers * 2
+        self.records = 0
+        self.written = 0
+        self.duplicates = 0
+        self._batches = {}
+        self._pending = []
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._started = perf_counter()
+        self._reported = self._started
+
+    def add(self, collection, operation):
+        key = collection.full_name
+        if key not in self._batches:
+            self._batches[key] = (collection, [])
+        operations = self._batches[key][1]
+        operations.append(operation)
+        if len(operations) >= self.batch_size:
+            self._submit(collection, operations)
+            self._batches[key] = (collection, [])
+
+    def _submit(self, collection, operations):
+        # bound the batches held in memory, wait for the oldest write
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(self._write, collection, operations))
+        if perf_counter() - self._reported >= PROGRESS_EVERY:
+            self.report()
+
+    def _write(self, collection, operations):
+        duplicates = 0
+        with metrics.timer("mongo_write", source="backfill"):
+            try:
+                result = collection.bulk_write(operations, ordered=False)
+                result = result.bulk_api_result
+            except BulkWriteError as e:
+                result = e.details
+                errors = result["writeErrors"]
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+                duplicates = len(errors)
+        written = result["nInserted"] + result["nUpserted"] + result["nModified"]
+        with self._lock:
+            self.written += written
+            self.duplicates += duplicates
+
+    def count_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def report(self):
+        self._reported = perf_counter()
+        elapsed = self._reported - self._started
+        with self._lock:
+            written, duplicates = self.written, self.duplicates
+        log.info(
+            f"{self.records} records read, {written} documents written, "
+            f"{duplicates} duplicates skipped in {elapsed:.1f}s "
+            f"({written / max(elapsed, 1e-9):.0f} docs/s)"
+        )
+
+    def close(self):
+        for collection, operations in self._batches.values():
+            if operations:
+                self._submit(collection, operations)
+        self._batches = {}
+        try:
+            for future in self._pending:
+                future.result()
+        finally:
+            self._pending = []
+            self._executor.shutdown(wait=True)
+        self.report()
+
+
+def tweet_operations(writer, records, screen_name=None):
+    """Tweets as returned by the API, or as stored by a previous dump"""
+    from tweepy_utils import TweetGetter
+
+    ingested_at = datetime.utcnow()
+    collections = {}
+    for status in records:
+        name = screen_name or status.get("user", {}).get("screen_name")
+        if name is None:
+            raise ValueError("screen_name=... is needed for tweets without a user")
+        if name not in collections:
+            collections[name] = get_collection("twitter", name)
+        if "id" in status:
+            tweet = TweetGetter.clean_status_json(status)
+        else:
+            tweet = slim_tweet(status)
+        tweet["_ingested_at"] = ingested_at
+        yield collections[name], pymongo.InsertOne(tweet)
+
+
+def forecast_id(weather, area):
+    """
+    The dump's ObjectId, else one dated at the forecast's modelRunDate so
+    retention sees its real age, with the rest derived from the area so the
+    same (area, modelRunDate) always gets the same id.
+    """
+    if isinstance(weather.get("_id"), ObjectId):
+        return weather["_id"]
+    model_run_date = weather["features"][0]["properties"]["modelRunDate"]
+    issued = datetime.strptime(model_run_date, "%Y-%m-%dT%H:%MZ")
+    timestamp = ObjectId.from_datetime(issued).binary[:4]
+    return ObjectId(timestamp + hashlib.sha1(area.encode()).digest()[:8])
+
+
+def forecast_operations(writer, records, area=None):
+    """Met Office hourly forecast responses, the area from `_area` or area=..."""
+    hourly = get_collection("metoffice", "hourly")
+    # not get_timesteps_collection, that would build the index up front
+    timesteps = get_collection("metoffice", "timesteps")
+    seen = set()
+    for weather in records:
+        weather_area = weather.get("_area", area)
+        if weather_area is None:
+            raise ValueError("area=... is needed for forecasts without an _area")
+        docs = flatten_forecast(weather, weather_area)
+        if not docs or docs[0]["_id"] in seen:
+            continue
+        seen.add(docs[0]["_id"])
+        weather["_id"] = forecast_id(weather, weather_area)
+        weather["_area"] = weather_area
+        yield hourly, pymongo.ReplaceOne({"_id": weather["_id"]}, weather, upsert=True)
+        for doc in docs:
+            yield timesteps, pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+
+
+def article_operations(writer, records):
+    """NewsAPI articles, one per line or whole /everything responses"""
+    collection = get_collection("googlenews", "articleItems")
+    # the unique url index is built after the load, so dedupe here instead
+    seen = {doc["url"] for doc in collection.find({}, projection={"url": 1})}
+    ingested_at = datetime.utcnow()
+    latest = None
+    for record in records:
+        articles = record["articles"] if "articles" in record else [record]
+        for article in clean_articles(articles, ingested_at):
+            if article["url"] in seen:
+                writer.count_duplicate()
+                continue
+            seen.add(article["url"])
+            if latest is None or article["publishedAt"] > latest:
+                latest = article["publishedAt"]
+            yield collection, pymongo.InsertOne(article)
+    if latest is not None:
+        save_news_checkpoint(latest)
+
+
+def current_events_operations(writer, records):
+    """Current events documents as stored by the wiki upload"""
+    collection = get_collection("wiki", "currentEvents")
+    for doc in records:
+        if "_hash" not in doc:
+            doc["_hash"] = hashlib.sha256(doc["text"].encode()).hexdigest()
+        yield collection, pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+
+
+SOURCE_OPERATIONS = {
+    "twitter": tweet_operations,
+    "met-office": forecast_operations,
+    "google-news": article_operations,
+    "wiki": current_events_operations,
+}
+# the indexes the aggregator would have built as it went
+SOURCE_INDEXES = {
+    "met-office": get_timesteps_collection,
+    "google-news": get_articles_collection,
+}
+
+
+def backfill(source, paths, batch_size=BATCH_SIZE, workers=WORKERS, **kwargs):
+    """
+    Load dumps of `source` through the aggregator's cleaning code, then build
+    the source's indexes and refresh the digests. Returns documents written.
+    """
+    if source not in SOURCE_OPERATIONS:
+        raise ValueError(f"Data source {source} not recognised.")
+    writer = BulkWriter(batch_size=int(batch_size), workers=int(workers))
+    records = read_jsonl(paths)
+
+    def counted(records):
+        for record in records:
+            writer.records += 1
+            yield record
+
+    with metrics.timer("backfill", source=source):
+        try:
+            operations = SOURCE_OPERATIONS[source](writer, counted(records), **kwargs)
+            for collection, operation in operations:
+                writer.add(collection, operation)
+        finally:
+            writer.close()
+        if source in SOURCE_INDEXES:
+            with metrics.timer("index_build", source=source):
+                SOURCE_INDEXES[source]()
+            log.info(f"indexes for {source} built")
+    metrics.inc("documents_written_total", writer.written, source=source)
+    if writer.written:
+        refresh_digests(source)
+    return writer.written
+
+
+if __name__ == "__main__":
+    """
+    python backfill.py source=twitter path=tweets.jsonl screen_name=tweetthetube
+    python backfill.py source=met-office path=hourly.jsonl.gz
+    python backfill.py source=google-news path=2021-01.jsonl,2021-02.jsonl
+    python backfill.py source=wiki path=current_events.jsonl batch_size=500
+    """
+    kwargs = dict([arg.split("=") for arg in sys.argv[1:]])
+    paths = kwargs.pop("path").split(",")
+    backfill(paths=paths, **kwargs)
+    metrics.export("backfill")
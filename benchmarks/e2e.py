@@ -0,0 +1,493 @@
+"""
+Offline end to end benchmark of the aggregator and emailer.
+
+    python benchmarks/e2e.py
+    python benchmarks/e2e.py iterations=50 volume=500 recipients=200 json=bench.json
+
+Everything runs against local stand-ins:
+- an in-process HTTP server replaying the payloads in benchmarks/payloads
+  (Met Office, NewsAPI, Twitter, Citymapper, Wikipedia), scaled to `volume`
+  timesteps/articles/tweets/events. Upstream requests are routed to it by
+  mounting an adapter on the http_utils sessions
+- mongomock (pip install mongomock), or mongo_uri=... pointing at a
+  throwaway MongoDB instance, it is written to and cleared
+- an in-process SMTP sink
+- a temporary HOME with dummy credentials under ~/keys
+
+Each scenario reports latency percentiles and throughput over `iterations`
+runs, then allocations from a separate pass under tracemalloc so tracing
+does not skew the timings. With fresh=1 (default) each upload starts from
+empty collections; cold=1 clears the render and section caches before each
+email build.
+"""
+import hashlib
+import json
+import logging as log
+import os
+import smtplib
+import socketserver
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAYLOADS = os.path.join(REPO_ROOT, "benchmarks", "payloads")
+sys.path.insert(0, REPO_ROOT)
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+DATABASES = ["twitter", "metoffice", "wiki", "googlenews"]
+
+
+def load_payload(name):
+    with open(os.path.join(PAYLOADS, name), "r") as f:
+        if name.endswith(".json"):
+            return json.loads(f.read())
+        return f.read()
+
+
+class Payloads:
+    """Recorded payloads replicated up to `volume` items"""
+
+    def __init__(self, volume):
+        self.volume = volume
+        now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        self.met_office = self._met_office(now)
+        self.news = self._news(now)
+        self.tweets = self._tweets(now)
+        self.citymapper = json.dumps(load_payload("citymapper_traveltimes.json"))
+        self.wiki = self._wiki()
+        self.wiki_etag = '"' + hashlib.md5(self.wiki.encode()).hexdigest() + '"'
+
+    def _met_office(self, now):
+        payload = load_payload("met_office_hourly.json")
+        properties = payload["features"][0]["properties"]
+        template = properties["timeSeries"][0]
+        start = now.replace(hour=0)
+        properties["modelRunDate"] = now.strftime("%Y-%m-%dT%H:%MZ")
+        # at least two days so every configured email hour is covered
+        properties["timeSeries"] = [
+            {
+                **template,
+                "time": (start + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%MZ"),
+                "screenTemperature": template["screenTemperature"] + i % 7,
+                "windDirectionFrom10m": (template["windDirectionFrom10m"] + 15 * i) % 360,
+            }
+            for i in range(max(self.volume, 48))
+        ]
+        return json.dumps(payload)
+
+    def _news(self, now):
+        payload = load_payload("newsapi_everything.json")
+        template = payload["articles"][0]
+        payload["articles"] = [
+            {
+                **template,
+                "title": f"{template['title']} ({i})",
+                "url": f"{template['url']}-{i}",
+                "publishedAt": (now - timedelta(minutes=i)).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+            }
+            for i in range(self.volume)
+        ]
+        payload["totalResults"] = len(payload["articles"])
+        return json.dumps(payload)
+
+    def _tweets(self, now):
+        template = load_payload("twitter_user_timeline.json")[0]
+        tweets = []
+        for i in range(self.volume):
+            tweet_id = template["id"] - i
+            created_at = now - timedelta(minutes=3 * i)
+            tweets.append(
+                {
+                    **template,
+                    "id": tweet_id,
+                    "id_str": str(tweet_id),
+                    "created_at": created_at.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+                }
+            )
+        return tweets
+
+    def _wiki(self):
+        template = load_payload("wiki_current_events.html")
+        now = datetime.now()
+        items = "".join(
+            f'<li><a href="/wiki/Event_{i}">Event {i}</a> happened in '
+            f'<a href="/wiki/Place_{i}">place {i}</a>.</li>'
+            for i in range(self.volume)
+        )
+        return (
+            template.replace("{date_id}", now.strftime("%Y_%B_%-d"))
+            .replace("{date_heading}", now.strftime("%B %-d, %Y"))
+            .replace("{items}", f"<ul>{items}</ul>")
+        )
+
+    def timeline(self, query):
+        """user_timeline page honouring since_id, max_id and count"""
+        since_id = int(query.get("since_id", ["0"])[0])
+        max_id = int(query.get("max_id", [str(2**63)])[0])
+        count = int(query.get("count", ["20"])[0])
+        page = [t for t in self.tweets if since_id < t["id"] <= max_id][:count]
+        return json.dumps(page)
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    payloads = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        headers = {}
+        if "/forecasts/point/hourly" in url.path:
+            body = self.payloads.met_office
+        elif "/v2/everything" in url.path:
+            body = self.payloads.news
+        elif "/statuses/user_timeline" in url.path:
+            body = self.payloads.timeline(query)
+        elif "/traveltimes" in url.path:
+            body = self.payloads.citymapper
+        elif "/wiki/Portal:Current_events" in url.path:
+            if self.headers.get("If-None-Match") == self.payloads.wiki_etag:
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = self.payloads.wiki
+            headers["ETag"] = self.payloads.wiki_etag
+            headers["Content-Type"] = "text/html; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        headers.setdefault("Content-Type", "application/json")
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(payloads):
+    handler = type("Handler", (ReplayHandler,), {"payloads": payloads})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def route_sessions_to(server):
+    """Send every upstream request made through http_utils to the local server"""
+    import http_utils
+    from requests.adapters import HTTPAdapter
+
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+    class LocalRedirectAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            url = urlsplit(request.url)
+            request.url = base_url + url.path + (f"?{url.query}" if url.query else "")
+            return super().send(request, **kwargs)
+
+    adapter = LocalRedirectAdapter(pool_connections=4, pool_maxsize=16)
+    for endpoint, settings in http_utils.ENDPOINTS.items():
+        session = http_utils.get_session(endpoint)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # upstream quotas do not apply to the replay server
+        settings.pop("quota", None)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib.send_message, messages are counted and dropped"""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 localhost SMTP sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].decode().upper()
+            if command == "EHLO" or command == "HELO":
+                self.reply("250 localhost")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            else:
+                self.reply("502 Command not implemented")
+
+
+def start_smtp_sink():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSinkHandler)
+    server.daemon_threads = True
+    server.messages = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def sink_sender_class(smtp_server):
+    from emailer import EmailSender
+
+    class SinkEmailSender(EmailSender):
+        def connect(self):
+            self._server = smtplib.SMTP(*smtp_server.server_address)
+            return self._server
+
+    return SinkEmailSender
+
+
+def write_dummy_credentials(home):
+    def write(path, content):
+        path = os.path.join(home, "keys", path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    for name in [
+        "twitter_key",
+        "twitter_secret_key",
+        "twitter_access_token",
+        "twitter_secret_access_token",
+    ]:
+        write(f"twitter/{name}", "dummy\n")
+    write("city-mapper/api_key", "dummy\n")
+    write("google-news-api/news_api_key", "dummy\n")
+    write(
+        "met-office/auth.json",
+        json.dumps({"client-id": "dummy", "client-secret": "dummy"}),
+    )
+    write(
+        "gmail/sender_config.json",
+        json.dumps(
+            {
+                "sender_email": "sender@example.com",
+                "receiver_email": "receiver@example.com",
+                "sender_password": "dummy",
+            }
+        ),
+    )
+    write(
+        "aws/ses-credentials.json",
+        json.dumps({"smtp-username": "dummy", "smtp-password": "dummy"}),
+    )
+
+
+def setup_mongo(mongo_uri=None):
+    import mongo_utils
+
+    if mongo_uri is None:
+        import mongomock
+
+        client = mongomock.MongoClient()
+    else:
+        os.environ["MONGO_URI"] = mongo_uri
+        client = mongo_utils.get_client()
+    mongo_utils.set_client(client)
+    return client
+
+
+def clear_collections(client):
+    for db_name in DATABASES:
+        db = client[db_name]
+        for name in db.list_collection_names():
+            db[name].delete_many({})
+
+
+def percentile(values, q):
+    """Nearest rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def measure(name, func, iterations, setup=None, allocation_runs=3):
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(allocation_runs, iterations)):
+        if setup is not None:
+            setup()
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - baseline)
+    tracemalloc.stop()
+
+    total = sum(timings)
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p90_ms": percentile(timings, 90) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "max_ms": max(timings) * 1000,
+        "throughput_per_s": iterations / total if total else float("inf"),
+        "peak_alloc_kib": max(peaks) / 1024 if peaks else None,
+    }
+
+
+def report(results):
+    header = (
+        f"{'scenario':<28} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+        f"{'max ms':>9} {'ops/s':>9} {'peak KiB':>10}"
+    )
+    log.info(header)
+    for r in results:
+        log.info(
+            f"{r['scenario']:<28} {r['p50_ms']:9.2f} {r['p90_ms']:9.2f} "
+            f"{r['p99_ms']:9.2f} {r['max_ms']:9.2f} {r['throughput_per_s']:9.1f} "
+            f"{r['peak_alloc_kib']:10.1f}"
+        )
+
+
+def main(
+    iterations=20,
+    volume=100,
+    recipients=50,
+    fresh=1,
+    cold=0,
+    mongo_uri=None,
+    json_path=None,
+):
+    iterations, volume, recipients = int(iterations), int(volume), int(recipients)
+    fresh, cold = bool(int(fresh)), bool(int(cold))
+
+    os.chdir(REPO_ROOT)
+    home = tempfile.mkdtemp(prefix="email-service-bench-")
+    os.environ["HOME"] = home
+    os.environ["SECTION_CACHE_PATH"] = os.path.join(home, "sections.db")
+    write_dummy_credentials(home)
+
+    http_server = start_http_server(Payloads(volume))
+    smtp_server = start_smtp_sink()
+    route_sessions_to(http_server)
+    client = setup_mongo(mongo_uri)
+
+    from data_aggregator import upload
+    from emailer import create_email_html_body, get_config, send_emails
+    from render_cache import render_cache
+    from section_cache import section_cache
+
+    reset = (lambda: clear_collections(client)) if fresh else None
+    uploads = [
+        (
+            "upload twitter",
+            dict(
+                source="twitter",
+                screen_name="tweetthetube",
+                count=200,
+                tweet_mode="extended",
+            ),
+        ),
+        ("upload met-office area=all", dict(source="met-office", area="all")),
+        ("upload wiki", dict(source="wiki")),
+        ("upload google-news", dict(source="google-news")),
+    ]
+    results = []
+    for name, kwargs in uploads:
+        results.append(
+            measure(name, lambda kwargs=kwargs: upload(**kwargs), iterations, reset)
+        )
+
+    # seed every source once for the emailer scenarios
+    clear_collections(client)
+    for _, kwargs in uploads:
+        upload(**kwargs)
+
+    config = {
+        **get_config("morning.json"),
+        "sections": ["weather", "travel", "current_events", "twitter", "news"],
+    }
+    def clear_caches():
+        render_cache.clear()
+        section_cache.clear()
+
+    reset_caches = clear_caches if cold else None
+    results.append(
+        measure(
+            "create_email_html_body",
+            lambda: create_email_html_body(**config),
+            iterations,
+            reset_caches,
+        )
+    )
+
+    sender_class = sink_sender_class(smtp_server)
+    html = create_email_html_body(**config)
+    with sender_class(use_ses=False) as sender:
+        results.append(
+            measure(
+                "send_email (warm session)",
+                lambda: sender.send(html, "receiver@example.com"),
+                iterations,
+            )
+        )
+
+    recipient_list = [
+        {
+            "receiver_email": f"recipient{i}@example.com",
+            "config": "morning.json" if i % 2 else "afternoon.json",
+        }
+        for i in range(recipients)
+    ]
+    results.append(
+        measure(
+            f"send_emails x{recipients}",
+            lambda: send_emails(recipient_list, use_ses=False, sender_class=sender_class),
+            max(iterations // 5, 1),
+            reset_caches,
+        )
+    )
+
+    log.getLogger().setLevel(log.INFO)
+    report(results)
+    log.info(f"{smtp_server.messages} messages delivered to the SMTP sink")
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            f.write(json.dumps(results, indent=4))
+        log.info(f"results written to {json_path}")
+
+    http_server.shutdown()
+    smtp_server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    args = dict([arg.split("=") for arg in sys.argv[1:]])
+    if "json" in args:
+        args["json_path"] = args.pop("json")
+    if "quiet" in args and int(args.pop("quiet")):
+        log.getLogger().setLevel(log.WARNING)
+    main(**args)
@@ -0,0 +1,83 @@
+"""
+Cold start import time of the CLI entry points.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py repeats=20 budget_ms=250 top=15
+
+Each module is imported in a fresh interpreter with `-X importtime`; the
+median cumulative import time is compared against the budget and the
+heaviest imports from the slowest run are listed. Exits non-zero if any
+entry point is over budget.
+"""
+import logging as log
+import os
+import statistics
+import subprocess
+import sys
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ["emailer", "data_aggregator"]
+
+
+def parse_importtime(stderr):
+    """{module: (self_us, cumulative_us)} from `python -X importtime` output"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def measure(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def benchmark(module, repeats, top):
+    runs = [measure(module) for _ in range(repeats)]
+    totals_ms = [run[module][1] / 1000 for run in runs]
+    slowest = runs[totals_ms.index(max(totals_ms))]
+    heaviest = sorted(slowest.items(), key=lambda item: item[1][1], reverse=True)
+    # top level packages only, their submodules are included in the cumulative time
+    heaviest = [(name, times) for name, times in heaviest if "." not in name]
+    return {
+        "module": module,
+        "median_ms": statistics.median(totals_ms),
+        "min_ms": min(totals_ms),
+        "max_ms": max(totals_ms),
+        "heaviest": heaviest[1 : top + 1],
+    }
+
+
+def main(repeats=10, budget_ms=300, top=10):
+    over_budget = []
+    for module in ENTRY_POINTS:
+        result = benchmark(module, int(repeats), int(top))
+        log.info(
+            f"{module}: median {result['median_ms']:.1f}ms "
+            f"(min {result['min_ms']:.1f}ms, max {result['max_ms']:.1f}ms, "
+            f"budget {float(budget_ms):.0f}ms)"
+        )
+        for name, (_, cumulative_us) in result["heaviest"]:
+            log.info(f"    {name:<30} {cumulative_us / 1000:8.1f}ms")
+        if result["median_ms"] > float(budget_ms):
+            over_budget.append(module)
+    if over_budget:
+        log.error(f"over the import time budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = dict([arg.split("=") for arg in sys.argv[1:]])
+    sys.exit(main(**args))
@@ -1,33 +1,29 @@
-import json
 import logging as log
-import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic
 
-import requests
+import metrics
+from config_utils import get_location_config, load_key_text
 
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 base_endpoint = "https://api.external.citymapper.com/api/1"
 
+# journey times barely move within a few minutes
+TRAVEL_TIME_TTL = 300
 
-def _get_citymapper_auth():
-    home = os.path.expanduser("~")
-    with open(f"{home}/keys/city-mapper/api_key", "r") as f:
-        key = f.read().rstrip("\n")
-    return {"Citymapper-Partner-Key": key}
+_travel_times = {}
+_in_flight = {}
+_lock = threading.Lock()
 
 
-def get_location_config(area=None):
-    with open(f"./configs/location.json", "r") as f:
-        location = json.loads(f.read())
-    if area is None:
-        return location
-    else:
-        return location[area]
-
+def _get_citymapper_auth():
+    key = load_key_text("city-mapper", "api_key")
+    return {"Citymapper-Partner-Key": key}
 
-def get_travel_time(start, end):
-    """Response JSON like {"transit_time_minutes": 28}"""
 
+def _fetch_travel_time(start, end, travel_type="transit"):
     location_config = get_location_config()
     start_lat = location_config[start]["latitude"]
     start_long = location_config[start]["longitude"]
@@ -36,29 +32,83 @@ def get_travel_time(start, end):
     params = {
         "start": f"{start_lat},{start_long}",
         "end": f"{end_lat},{end_long}",
-        "traveltime_types": "transit",
+        "traveltime_types": travel_type,
     }
+    import http_utils
+
     headers = _get_citymapper_auth()
-    r = requests.get(
-        url=f"{base_endpoint}/traveltimes", params=params, headers=headers, timeout=1
+    r = http_utils.get(
+        "citymapper", f"{base_endpoint}/traveltimes", params=params, headers=headers
     )
     r.raise_for_status()
     return r.json()
 
 
-def get_journey_info(**kwargs):
-    locations = kwargs["weather"]
-    hour_start = 24
-    hour_end = 0
-    for loc_info in locations:
-        if list(loc_info.values())[0] < hour_start:
-            start, hour_start = tuple(loc_info.items())[0]
-        if list(loc_info.values())[0] > hour_end:
-            end, hour_end = tuple(loc_info.items())[0]
+def get_travel_time(start, end, travel_type="transit"):
+    """
+    Response JSON like {"transit_time_minutes": 28}. Results are cached for
+    TRAVEL_TIME_TTL seconds per (start, end, travel_type), and concurrent
+    callers asking for the same route share a single in-flight request.
+    """
+    key = (start, end, travel_type)
+    with _lock:
+        cached = _travel_times.get(key)
+        if cached is not None and cached[0] > monotonic():
+            metrics.inc("travel_time_cache_total", result="hit")
+            return cached[1]
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _in_flight[key] = future
+    if not owner:
+        metrics.inc("travel_time_cache_total", result="coalesced")
+        return future.result()
 
+    metrics.inc("travel_time_cache_total", result="miss")
     try:
-        travel_time = get_travel_time(start, end)
-    except requests.exceptions.ReadTimeout:
-        log.info("get_travel_time: requests.exceptions.ReadTimeout")
-        travel_time = {"transit_time_minutes": None}
-    return {"start": start, "end": end, "travel_time": travel_time}
+        travel_time = _fetch_travel_time(start, end, travel_type)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        with _lock:
+            _travel_times[key] = (monotonic() + TRAVEL_TIME_TTL, travel_time)
+        future.set_result(travel_time)
+        return travel_time
+    finally:
+        with _lock:
+            _in_flight.pop(key, None)
+
+
+def get_journey(**kwargs):
+    """(start, end) of the journey implied by the earliest and latest weather areas"""
+    # hours are whole (8) or "HH:MM" ("08:30"), compare them as times of day
+    from forecast_utils import parse_clock
+
+    areas = [tuple(loc_info.items())[0] for loc_info in kwargs["weather"]]
+    start = min(areas, key=lambda area: parse_clock(area[1]))[0]
+    end = max(areas, key=lambda area: parse_clock(area[1]))[0]
+    return start, end
+
+
+def get_travel_times(routes, max_workers=8):
+    """
+    Resolve many (start, end) or (start, end, travel_type) routes at once.
+    Distinct routes are fetched concurrently and the results land in the
+    cache, returns {route: travel_time}, failed routes are left out.
+    """
+    import requests
+
+    routes = list(dict.fromkeys(tuple(route) for route in routes))
+    travel_times = {}
+    if not routes:
+        return travel_times
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(routes))) as executor:
+        futures = {route: executor.submit(get_travel_time, *route) for route in routes}
+        for route, future in futures.items():
+            try:
+                travel_times[route] = future.result()
+            except requests.exceptions.RequestException as e:
+                log.info(f"get_travel_time {route}: {e!r}")
+    return travel_times
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _load(path, parse):
+    """
+    Parse the file at path once and cache it, re-reading only when its mtime
+    changes. Cached values are shared between callers, treat them as read only.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, "r") as f:
+        value = parse(f.read())
+    with _cache_lock:
+        _cache[path] = (mtime, value)
+    return value
+
+
+def load_json(path):
+    return _load(path, json.loads)
+
+
+def load_text(path):
+    return _load(path, lambda text: text.strip())
+
+
+def get_config_path(name):
+    return f"./configs/{name}"
+
+
+def get_key_path(*parts):
+    home = os.path.expanduser("~")
+    return os.path.join(home, "keys", *parts)
+
+
+def load_config_json(name):
+    return load_json(get_config_path(name))
+
+
+def load_key_json(*parts):
+    return load_json(get_key_path(*parts))
+
+
+def load_key_text(*parts):
+    return load_text(get_key_path(*parts))
+
+
+def get_location_config(area=None):
+    location = load_config_json("location.json")
+    if area is None:
+        return location
+    else:
+        return location[area]
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -1,20 +1,65 @@
 import logging as log
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from time import perf_counter
 
-from pymongo import MongoClient
-
-from met_office_utils import get_location_config, get_met_office_weather
-from news_utils import get_google_news, get_google_news_sources, get_wiki_current_events
-from tweepy_utils import TweetGetter
+import metrics
+from config_utils import get_location_config, load_config_json
+from digest_utils import refresh_digests
+from met_office_utils import (
+    flatten_forecast,
+    get_met_office_weather,
+    get_met_office_weather_batch,
+    get_timesteps_collection,
+)
+from mongo_utils import get_client, insert_new, upsert_many
+from news_utils import (
+    get_articles_collection,
+    get_google_news,
+    get_google_news_sources,
+    get_news_checkpoint,
+    get_wiki_current_events,
+    get_wiki_validators,
+    save_news_checkpoint,
+    save_wiki_validators,
+)
+from schema_utils import parse_article_date, slim_article
 
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# the http_utils endpoint whose quota each source spends
+SOURCE_ENDPOINTS = {
+    "twitter": "twitter",
+    "met-office": "met-office",
+    "wiki": "wiki",
+    "google-news": "newsapi",
+}
+
+
+def get_tweets(tweet_getter=None, max_pages=10, **kwargs):
+    """
+    Page back through user_timeline until since_id (or max_pages pages,
+    whichever comes first). kwargs are passed on to user_timeline.
+    """
+    from tweepy import Cursor
 
-def get_tweets(**kwargs):
-    tweet_getter = TweetGetter()
-    result_set = tweet_getter.api.user_timeline(**kwargs)
-    tweets = [tweet_getter.clean_status_object(status) for status in result_set]
+    import http_utils
+    from tweepy_utils import TweetGetter
+
+    if tweet_getter is None:
+        tweet_getter = TweetGetter()
+    cursor = Cursor(tweet_getter.api.user_timeline, **kwargs)
+    tweets = []
+    pages = cursor.pages(int(max_pages))
+    while True:
+        http_utils.acquire_quota("twitter")
+        with metrics.timer("http_fetch", endpoint="twitter"):
+            page = next(pages, None)
+        if page is None:
+            break
+        with metrics.timer("parse", source="twitter"):
+            tweets.extend(tweet_getter.clean_status_object(status) for status in page)
     return tweets
 
 
@@ -24,75 +69,153 @@ def get_weather(area=None):
     return weather
 
 
+def get_weather_areas(area):
+    """area=all for every configured location, or a comma separated list of areas"""
+    locations = get_location_config()
+    if area == "all":
+        return locations
+    return {name: locations[name] for name in area.split(",")}
+
+
+def clean_articles(articles, ingested_at=None):
+    """NewsAPI articles with a url in the compact schema, stamped for the TTL index"""
+    if ingested_at is None:
+        ingested_at = datetime.utcnow()
+    cleaned = [slim_article(article) for article in articles if article.get("url")]
+    for article in cleaned:
+        article["_ingested_at"] = ingested_at
+    return cleaned
+
+
 def upload(source, **kwargs):
-    client = MongoClient()
+    with metrics.timer("upload", source=source):
+        count = _upload(source, **kwargs)
+    metrics.inc("documents_written_total", count, source=source)
+    if count:
+        with metrics.timer("digest", source=source):
+            refresh_digests(source)
+    return count
+
+
+def _upload(source, **kwargs):
+    client = get_client()
 
     if source == "twitter":
         db = client["twitter"]
-        collection = db[kwargs["screen_name"]]
-        max_id_doc = collection.find_one(sort=[("_id", -1)])
-        if max_id_doc is not None:
-            kwargs["since_id"] = max_id_doc["_id"]
+        from tweepy_utils import TweetGetter
 
         log.info(f"Aggregating from {source}")
+        tweet_getter = TweetGetter()
+        inserted = 0
+        for screen_name in kwargs.pop("screen_name").split(","):
+            collection = db[screen_name]
+            params = {**kwargs, "screen_name": screen_name}
+            with metrics.timer("mongo_read", source=source):
+                max_id_doc = collection.find_one(sort=[("_id", -1)])
+            if max_id_doc is not None:
+                params["since_id"] = max_id_doc["_id"]
 
-        tweets = get_tweets(**kwargs)
-        log.info(f"{len(tweets)} tweets retrieved")
+            tweets = get_tweets(tweet_getter=tweet_getter, **params)
+            log.info(f"{len(tweets)} tweets retrieved for {screen_name}")
+            ingested_at = datetime.utcnow()
+            for tweet in tweets:
+                tweet["_ingested_at"] = ingested_at
 
-        if not tweets:
-            return
-        else:
-            result = collection.insert_many(tweets[::-1])
-            log.info(
-                f"Succesfully inserted {result.inserted_ids} into {collection.name}"
-            )
-        return
+            with metrics.timer("mongo_write", source=source):
+                count = insert_new(collection, tweets)
+            log.info(f"Succesfully inserted {count} tweets into {collection.name}")
+            inserted += count
+        return inserted
 
     elif source == "met-office":
         db = client["metoffice"]
         collection = db["hourly"]
         log.info(f"Aggregating from {source}")
-        weather = get_weather(**kwargs)
-        weather["_area"] = kwargs["area"]
-        result = collection.insert_one(weather)
-        log.info(f"Succesfully inserted {result.inserted_id} into {collection.name}")
-        return
+        area = kwargs["area"]
+        if area == "all" or "," in area:
+            forecasts = get_met_office_weather_batch(get_weather_areas(area))
+        else:
+            forecasts = {area: get_weather(area)}
+        if not forecasts:
+            log.info("No forecasts retrieved")
+            return 0
+        timesteps = {}
+        with metrics.timer("parse", source=source):
+            for area, weather in forecasts.items():
+                weather["_area"] = area
+                timesteps[area] = flatten_forecast(weather, area)
+        # timestep ids carry the issue time, so an issue already stored has
+        # its first timestep stored too
+        first_ids = {area: docs[0]["_id"] for area, docs in timesteps.items() if docs}
+        with metrics.timer("mongo_read", source=source):
+            stored = {
+                doc["_id"]
+                for doc in get_timesteps_collection().find(
+                    {"_id": {"$in": list(first_ids.values())}}, projection={"_id": 1}
+                )
+            }
+        new_areas = [area for area, _id in first_ids.items() if _id not in stored]
+        if not new_areas:
+            log.info(f"No new forecast issue for {list(forecasts)}")
+            return 0
+        with metrics.timer("mongo_write", source=source):
+            result = collection.insert_many([forecasts[area] for area in new_areas])
+            upsert_many(
+                get_timesteps_collection(),
+                [doc for area in new_areas for doc in timesteps[area]],
+            )
+        log.info(
+            f"Succesfully inserted {result.inserted_ids} into {collection.name}"
+        )
+        log.info(f"Upserted timesteps of the new forecast issue for {new_areas}")
+        return len(result.inserted_ids)
 
     elif source == "wiki":
         db = client["wiki"]
         collection = db["currentEvents"]
-        max_id_doc = collection.find_one(sort=[("_id", -1)])
-        if max_id_doc is None:  # no documents
-            max_id = 0
-        else:
-            max_id = max_id_doc["_id"]
         log.info(f"Aggregating from {source}")
-        current_events = get_wiki_current_events()
+        with metrics.timer("mongo_read", source=source):
+            previous_validators = get_wiki_validators()
+        current_events, validators = get_wiki_current_events(previous_validators)
+
+        def save_validators():
+            # only once the page is stored, else a 304 would hide the change
+            if validators != previous_validators:
+                with metrics.timer("mongo_write", source=source):
+                    save_wiki_validators(validators)
+
         if current_events is None:
-            log.info("No section published for today's current events on wiki")
-            return
-        else:
+            save_validators()
+            return 0
+        with metrics.timer("mongo_read", source=source):
+            existing = collection.find_one(
+                {"_id": current_events["_id"]}, projection={"_hash": 1}
+            )
+        if existing is not None and existing.get("_hash") == current_events["_hash"]:
+            log.info(f"Document {current_events['_id']} unchanged")
+            save_validators()
+            return 0
+        with metrics.timer("mongo_write", source=source):
             collection.replace_one(
                 filter={"_id": current_events["_id"]},
                 replacement=current_events,
                 upsert=True,
             )
-            log.info(f"Document {current_events['_id']} updated")
-            return
+        save_validators()
+        log.info(f"Document {current_events['_id']} updated")
+        return 1
 
     elif source == "google-news":
-        db = client["googlenews"]
-        collection = db["articles"]
+        collection = get_articles_collection()
         sources = get_google_news_sources()
         log.info(f"Aggregating from {source}")
-        latest_articles = collection.find_one(sort=[("_id", -1)])
-        if latest_articles is not None:
-            latest_timestamp = max(
-                [article["publishedAt"] for article in latest_articles["articles"]]
+        with metrics.timer("mongo_read", source=source):
+            latest_timestamp = get_news_checkpoint()
+        if latest_timestamp is not None:
+            from_param = parse_article_date(latest_timestamp)
+            lookback_limit = (datetime.now() + timedelta(days=-29, hours=-23)).replace(
+                microsecond=0
             )
-            latest_timestamp = latest_timestamp.rstrip("Z")
-            from_param = datetime.strptime(latest_timestamp, "%Y-%m-%dT%H:%M:%S")
-            lookback_limit = (datetime.now() + timedelta(days=-29, hours=-23)).replace(microsecond=0)
             from_param = max(from_param, lookback_limit)
             from_param = str(from_param + timedelta(seconds=1))
             from_param = from_param.replace(" ", "T")
@@ -103,30 +226,84 @@ def upload(source, **kwargs):
             log.info(
                 f"Status={news['status']}, code={news['code']}, message: {news['message']}"
             )
-            return
-        if not news["articles"]:
+            return 0
+        articles = clean_articles(news["articles"])
+        if not articles:
             log.info("No new articles")
-            return
-        news.pop("status")
-        news.pop("totalResults")
-        result = collection.insert_one(news)
+            return 0
+        with metrics.timer("mongo_write", source=source):
+            inserted = insert_new(collection, articles, key="url")
+            save_news_checkpoint(max(article["publishedAt"] for article in articles))
         log.info(
-            f"Succesfully inserted {result.inserted_id} into collection {collection.name}"
+            f"Succesfully inserted {inserted} of {len(articles)} articles into collection {collection.name}"
         )
-        return
+        return inserted
 
     else:
         raise ValueError(f"Data source {source} not recognised.")
 
 
+def get_sources_manifest(manifest="sources.json"):
+    return load_config_json(manifest)
+
+
+def _timed_upload(job):
+    start = perf_counter()
+    try:
+        count = upload(**job)
+        error = None
+    except Exception as e:
+        log.exception(f"upload failed for {job}")
+        count = None
+        error = repr(e)
+    return {
+        **job,
+        "count": count,
+        "error": error,
+        "seconds": round(perf_counter() - start, 3),
+    }
+
+
+def upload_all(manifest="sources.json", max_workers=None):
+    """
+    Run every upload listed in the manifest concurrently. Each entry holds the
+    keyword arguments for a single `upload` call, e.g. {"source": "wiki"}.
+    Returns one result per entry with the number of documents written, the
+    error (if any) and the time taken.
+    """
+    jobs = get_sources_manifest(manifest)
+    if max_workers is None:
+        max_workers = len(jobs)
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_timed_upload, jobs))
+    for result in results:
+        status = "failed" if result["error"] else f"{result['count']} docs"
+        log.info(f"{result['source']}: {status} in {result['seconds']}s")
+    log.info(f"{len(results)} uploads finished in {perf_counter() - start:.3f}s")
+    return results
+
+
 if __name__ == "__main__":
     """
     Common CL args to pass:
     source=twitter screen_name=northernline count=5 tweet_mode=extended
+    source=twitter screen_name=northernline,tweetthetube count=200 max_pages=5
     source=met-office area=goodge_street
+    source=met-office area=all
+    source=met-office area=hendon_central,piccadilly_circus
     source=wiki
     source=google-news
+    source=all manifest=sources.json
     """
     kwargs = sys.argv[1:]
     kwargs = dict([arg.split("=") for arg in kwargs])
-    upload(**kwargs)
+    if kwargs.get("source") == "all":
+        kwargs.pop("source")
+        if "max_workers" in kwargs:
+            kwargs["max_workers"] = int(kwargs["max_workers"])
+        upload_all(**kwargs)
+        metrics.export("upload-all")
+    else:
+        upload(**kwargs)
+        metrics.export(f"upload-{kwargs['source']}")
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging as log
+from datetime import date, datetime
+
+import metrics
+from config_utils import load_config_json
+from met_office_utils import query_met_office_prediction
+from mongo_utils import get_collection
+from news_utils import query_news_articles, query_wiki_current_events
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+DEFAULT_SECTIONS = ["weather", "current_events", "news"]
+
+# digest section refreshed after an upload from each source
+SOURCE_SECTIONS = {
+    "twitter": "twitter",
+    "met-office": "weather",
+    "wiki": "current_events",
+    "google-news": "news",
+}
+
+
+def query_tweets(**config):
+    # tweepy_utils pulls in tweepy, only import it when the section is enabled
+    from tweepy_utils import query_tweets
+
+    return query_tweets(**config)
+
+
+DIGEST_QUERIES = {
+    "weather": query_met_office_prediction,
+    "current_events": lambda **config: query_wiki_current_events(),
+    "news": query_news_articles,
+    "twitter": query_tweets,
+}
+
+
+def digest_id(config):
+    """Stable id for a config, the emailer finds its digest from the config alone"""
+    key = {k: v for k, v in config.items() if k != "section_timeout"}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_digests_collection():
+    return get_collection("digests", "emails")
+
+
+def get_digest_configs(manifest="digests.json"):
+    """Email configs to keep digests for, e.g. ["morning.json", "afternoon.json"]"""
+    return load_config_json(manifest)
+
+
+def build_digest(config_name, config, sections=None):
+    """
+    Query each digest section of the config and store the results under
+    sections.<name> with the date they were built for. Sections not passed
+    are left as they are.
+    """
+    wanted = config.get("sections", DEFAULT_SECTIONS)
+    if sections is None:
+        sections = wanted
+    sections = [s for s in sections if s in wanted and s in DIGEST_QUERIES]
+    if not sections:
+        return None
+    now = datetime.now()
+    update = {"config_name": config_name, "updated_at": now}
+    for section in sections:
+        update[f"sections.{section}"] = {
+            "data": DIGEST_QUERIES[section](**config),
+            "date": now.strftime("%Y-%m-%d"),
+            "built_at": now,
+        }
+    with metrics.timer("mongo_write", source="digest"):
+        get_digests_collection().update_one(
+            {"_id": digest_id(config)}, {"$set": update}, upsert=True
+        )
+    log.info(f"digest for {config_name} refreshed: {', '.join(sections)}")
+    return sections
+
+
+def refresh_digests(source=None):
+    """Rebuild the digest sections fed by `source`, or every section if None"""
+    if source is None:
+        sections = None
+    elif source in SOURCE_SECTIONS:
+        sections = [SOURCE_SECTIONS[source]]
+    else:
+        return
+    for config_name in get_digest_configs():
+        try:
+            build_digest(config_name, load_config_json(config_name), sections)
+        except Exception:
+            log.exception(f"failed to refresh digest for {config_name}")
+
+
+def get_digest_sections(config, sections):
+    """Section data from the config's digest, only sections built for today"""
+    doc = get_digests_collection().find_one({"_id": digest_id(config)})
+    if doc is None:
+        return {}
+    today = date.today().strftime("%Y-%m-%d")
+    return {
+        section: entry["data"]
+        for section, entry in doc.get("sections", {}).items()
+        if section in sections and entry["date"] == today
+    }
+
+
+if __name__ == "__main__":
+    refresh_digests()
@@ -1,56 +1,99 @@
-import json
 import logging as log
-import os
 import smtplib
 import ssl
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from string import Template
+from time import perf_counter
 
-from met_office_utils import bearing_to_cardinal, query_met_office_prediction
+import metrics
+from city_mapper_utils import get_journey, get_travel_times
+from config_utils import load_config_json, load_key_json
+from digest_utils import (
+    DEFAULT_SECTIONS,
+    digest_id,
+    get_digest_sections,
+    query_tweets,
+)
+from met_office_utils import (
+    bearing_to_cardinal,
+    predictions_for,
+    query_met_office_datapoints,
+)
 from news_utils import query_news_articles, query_wiki_current_events
-from tweepy_utils import query_tweets
+from render_cache import doc_key, render_cache
+from section_cache import section_cache
 
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
 def get_email_credentials():
-    home = os.path.expanduser("~")
-    with open(f"{home}/keys/gmail/sender_config.json", "r") as f:
-        config = json.loads(f.read())
-    return config
+    return load_key_json("gmail", "sender_config.json")
 
 
 def get_aws_ses_credentials():
-    home = os.path.expanduser("~")
-    with open(f"{home}/keys/aws/ses-credentials.json", "r") as f:
-        config = json.loads(f.read())
-    return config
+    return load_key_json("aws", "ses-credentials.json")
+
+
+ARTICLE_TEMPLATE = Template(
+    """\
+            $headline
+            <i>Source: $source, $publish_time</i><br><br>
+        """
+)
+
+WEATHER_TEMPLATE = Template(
+    """\
+            <b>Time</b>: $time_clean -- <b>$area_clean</b><br>
+            <b>Temperature</b>: $temperature\u00b0C<br>
+
+        <b>Wind Speed</b>: $wind_speed mph from the $wind_dir. <br>
+
+        <b>Chance of precipitation</b>: $prob_of_precipitation% <br>
+        <b>Rate of precipitation</b>: $precipitation_rate mm/hour <br>
+        <hr>
+        """
+)
+
+TWEET_TEMPLATE = Template(
+    """\
+            <b> $time </b><br>
+            $text <br>
+        """
+)
 
 
 def news_to_html(articles):
-    body = ""
+    bodies = []
     for article in articles:
-        publish_time = article["publishedAt"].replace("T", " ").replace("Z", " ")
-        source_info = article["source"]
+        published_at = article["publishedAt"]
+        if isinstance(published_at, datetime):
+            publish_time = published_at.strftime("%Y-%m-%d %H:%M:%S ")
+        else:
+            publish_time = published_at.replace("T", " ").replace("Z", " ")
+        source_info = article.get("source") or ""
+        if isinstance(source_info, str):
+            source = source_info
         # API seems to be changing back and forth sometimes according to raw docs in mongodb
-        try:
-            source = source_info["name"]
-        except KeyError:
-            source = source_info["Name"]
+        elif "name" in source_info:
+            source = source_info["name"] or ""
+        else:
+            source = source_info.get("Name") or ""
         url = article.get("url")
         if url is None:
             headline = f"<b>{article['title']}</b><br>"
         else:
             headline = f"<a href={url}><b>{article['title']}</b></a><br>"
-        article_body = f"""\
-            {headline}
-            <i>Source: {source}, {publish_time}</i><br><br>
-        """
-
-        body += article_body
-    return body + "\n<hr>"
+        bodies.append(
+            ARTICLE_TEMPLATE.substitute(
+                headline=headline, source=source, publish_time=publish_time
+            )
+        )
+    return "".join(bodies) + "\n<hr>"
 
 
 def weather_to_html(weather_info):
@@ -62,23 +105,15 @@ def weather_to_html(weather_info):
         time_clean = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").strftime(
             "%d %b %H:%M %p"
         )
-
-        body = f"""\
-            <b>Time</b>: {time_clean} -- <b>{area_clean}</b><br>
-            <b>Temperature</b>: {round(weather["screenTemperature"], 2)}\u00b0C<br>
-        """
-
-        wind_speed = round(weather["windSpeed10m"] * 2.23694, 2)
-        wind_dir = bearing_to_cardinal(weather["windDirectionFrom10m"])
-        body += f"""
-        <b>Wind Speed</b>: {wind_speed} mph from the {wind_dir}. <br>
-        """
-
-        body += f"""
-        <b>Chance of precipitation</b>: {weather["probOfPrecipitation"]}% <br>
-        <b>Rate of precipitation</b>: {weather["precipitationRate"]} mm/hour <br>
-        <hr>
-        """
+        body = WEATHER_TEMPLATE.substitute(
+            time_clean=time_clean,
+            area_clean=area_clean,
+            temperature=round(weather["screenTemperature"], 2),
+            wind_speed=round(weather["windSpeed10m"] * 2.23694, 2),
+            wind_dir=bearing_to_cardinal(weather["windDirectionFrom10m"]),
+            prob_of_precipitation=weather["probOfPrecipitation"],
+            precipitation_rate=weather["precipitationRate"],
+        )
         html_bodies.append(body)
     return "<br>".join(html_bodies)
 
@@ -103,12 +138,12 @@ def tweets_to_html(tweets):
         return "<b> No recent relevant travel updates </b>"
     html_bodies = []
     for tweet in tweets:
-        time = tweet["created_at"][4:-11]
-        text = tweet["full_text"]
-        body = f"""\
-            <b> {time} </b><br>
-            {text} <br>
-        """
+        created_at = tweet["created_at"]
+        if isinstance(created_at, datetime):
+            time = created_at.strftime("%b %d %H:%M:%S")
+        else:
+            time = created_at[4:-11]
+        body = TWEET_TEMPLATE.substitute(time=time, text=tweet["full_text"])
         html_bodies.append(body)
     return "<br>".join(html_bodies) + "\n<hr>"
 
@@ -125,27 +160,338 @@ def current_events_to_html(current_events):
     return header + current_events["text"]
 
 
-def create_email_html_body(**config):
-    weather = query_met_office_prediction(**config)
-    current_events = query_wiki_current_events()
-    news = query_news_articles(**config)
+DEFAULT_SECTION_TIMEOUT = 10
+
+_section_executor = ThreadPoolExecutor(max_workers=12)
+# one at a time, refreshes are not time critical
+_refresh_executor = ThreadPoolExecutor(max_workers=1)
+
+
+# travel is resolved over the Citymapper API, every other section from Mongo
+SECTION_STAGES = {"travel": "http_fetch"}
+
+
+def _timed_call(section, func):
+    with metrics.timer(SECTION_STAGES.get(section, "mongo_read"), section=section):
+        return func()
+
+
+def run_queries(queries, timeout=DEFAULT_SECTION_TIMEOUT):
+    """
+    Run each query of {key: (section, func)} concurrently. Queries that fail
+    or are not back within `timeout` seconds of the start are left out.
+    """
+    futures = {
+        key: _section_executor.submit(_timed_call, section, func)
+        for key, (section, func) in queries.items()
+    }
+    deadline = perf_counter() + timeout
+    results = {}
+    for key, future in futures.items():
+        section = queries[key][0]
+        try:
+            results[key] = future.result(timeout=max(deadline - perf_counter(), 0))
+        except FuturesTimeoutError:
+            log.warning(f"{section} query timed out after {timeout}s")
+            metrics.inc("section_timeouts_total", section=section)
+        except Exception:
+            log.exception(f"{section} query failed")
+    return results
+
+
+def plan_queries(configs, missing):
+    """
+    One query per distinct piece of data the configs still need: the union
+    of weather (area, hour) pairs, the largest article count, the largest
+    tweet count per account, current events and the distinct journeys.
+    """
+    needing = {
+        section: [name for name, sections in missing.items() if section in sections]
+        for section in SECTION_RENDERERS
+    }
+    queries = {}
+    if needing["weather"]:
+        area_hours = {
+            tuple(cfg.items())[0]
+            for name in needing["weather"]
+            for cfg in configs[name]["weather"]
+        }
+        queries["weather"] = (
+            "weather",
+            lambda area_hours=area_hours: query_met_office_datapoints(area_hours),
+        )
+    if needing["current_events"]:
+        queries["current_events"] = ("current_events", query_wiki_current_events)
+    if needing["news"]:
+        articles = max(configs[name]["articles"] for name in needing["news"])
+        queries["news"] = (
+            "news",
+            lambda articles=articles: query_news_articles(articles=articles),
+        )
+    tweet_counts = {}
+    for name in needing["twitter"]:
+        twitter = configs[name]["twitter"]
+        count = twitter.get("tweet_count", 5)
+        screen_name = twitter["screen_name"]
+        tweet_counts[screen_name] = max(tweet_counts.get(screen_name, 0), count)
+    for screen_name, count in tweet_counts.items():
+        twitter = {"screen_name": screen_name, "tweet_count": count}
+        queries[("twitter", screen_name)] = (
+            "twitter",
+            lambda twitter=twitter: query_tweets(twitter=twitter),
+        )
+    if needing["travel"]:
+        routes = {get_journey(**configs[name]) for name in needing["travel"]}
+        queries["travel"] = ("travel", lambda routes=routes: get_travel_times(routes))
+    return queries
+
+
+def section_data(config, section, results):
+    """Cut one config's share out of the shared query results"""
+    if section == "weather":
+        return predictions_for(config["weather"], results["weather"])
+    if section == "current_events":
+        return results["current_events"]
+    if section == "news":
+        return results["news"][: config["articles"]]
+    if section == "twitter":
+        twitter = config["twitter"]
+        tweets = results[("twitter", twitter["screen_name"])]
+        return tweets[: twitter.get("tweet_count", 5)]
+    if section == "travel":
+        start, end = get_journey(**config)
+        travel_time = results["travel"].get((start, end))
+        if travel_time is None:
+            travel_time = {"transit_time_minutes": None}
+        return {"start": start, "end": end, "travel_time": travel_time}
+    raise ValueError(f"Section {section} not recognised.")
+
+
+def fetch_sections_data(configs, wanted):
+    """
+    {config_name: {section: data}} for the `wanted` sections of each config.
+    Digest sections are used where available, everything else is fetched
+    once for the whole batch. Results are written to the section cache.
+    """
+    data = {}
+    missing = {}
+    for name, sections in wanted.items():
+        try:
+            with metrics.timer("mongo_read", section="digest"):
+                data[name] = get_digest_sections(configs[name], sections)
+        except Exception:
+            log.exception("digest read failed, querying every section")
+            data[name] = {}
+        missing[name] = [s for s in sections if s not in data[name]]
+        log.info(f"{name}: {len(data[name])} sections served from the digest")
+
+    queries = plan_queries(configs, missing)
+    if queries:
+        timeout = max(
+            configs[name].get("section_timeout", DEFAULT_SECTION_TIMEOUT)
+            for name in wanted
+        )
+        results = run_queries(queries, timeout)
+        log.info(f"{len(queries)} queries run for {len(wanted)} configs")
+        for name, sections in missing.items():
+            for section in sections:
+                try:
+                    data[name][section] = section_data(configs[name], section, results)
+                except KeyError:
+                    # the shared query failed or timed out, a placeholder is shown
+                    continue
+    for name, sections_data in data.items():
+        section_cache.put_many(digest_id(configs[name]), sections_data)
+    return data
+
+
+def refresh_sections(configs, stale):
+    """Re-fetch the stale cached sections of {config_name: [section]}"""
+    claimed = {
+        name: section_cache.claim_refresh(
+            [(digest_id(configs[name]), section) for section in sections]
+        )
+        for name, sections in stale.items()
+    }
+    wanted = {
+        name: [section for _, section in keys] for name, keys in claimed.items() if keys
+    }
+    if not wanted:
+        return
+    try:
+        with metrics.timer("section_cache_refresh"):
+            fetch_sections_data(configs, wanted)
+    except Exception:
+        log.exception("section cache refresh failed")
+    finally:
+        for keys in claimed.values():
+            section_cache.release_refresh(keys)
+
+
+def get_sections_data(configs):
+    """
+    {config_name: {section: data}} for every config. Sections in the local
+    section cache are served straight away, stale ones are refreshed in the
+    background, and only sections missing from it wait on MongoDB. Sections
+    MongoDB cannot supply fall back to the last good cached entry.
+    """
+    data = {}
+    wanted = {}
+    stale = {}
+    for name, config in configs.items():
+        sections = config.get("sections", DEFAULT_SECTIONS)
+        cached = section_cache.get_many(digest_id(config), sections)
+        data[name] = {section: value for section, (value, _) in cached.items()}
+        stale[name] = [section for section, (_, fresh) in cached.items() if not fresh]
+        missing = [section for section in sections if section not in cached]
+        if missing:
+            wanted[name] = missing
+        metrics.inc("section_cache_total", len(missing), result="miss")
+        metrics.inc("section_cache_total", len(stale[name]), result="stale")
+        metrics.inc(
+            "section_cache_total", len(cached) - len(stale[name]), result="fresh"
+        )
+    stale = {name: sections for name, sections in stale.items() if sections}
+    if stale:
+        _refresh_executor.submit(refresh_sections, configs, stale)
+    if wanted:
+        try:
+            fetched = fetch_sections_data(configs, wanted)
+        except Exception:
+            log.exception("section fetch failed, falling back to the section cache")
+            fetched = {}
+        for name, sections in wanted.items():
+            data[name].update(fetched.get(name, {}))
+            unavailable = [section for section in sections if section not in data[name]]
+            last_good = section_cache.get_many(
+                digest_id(configs[name]), unavailable, any_age=True
+            )
+            for section, (value, _) in last_good.items():
+                data[name][section] = value
+            metrics.inc("section_cache_total", len(last_good), result="last_good")
+            if last_good:
+                log.warning(f"{name}: last good {', '.join(last_good)} served")
+    return data
+
 
-    weather_html = weather_to_html(weather)
-    log.info("weather html body created")
-    current_events_html = current_events_to_html(current_events)
-    log.info("current events html body created")
-    news_html = news_to_html(news)
-    log.info("news html body created")
+def warm_section_cache(config_names):
+    """
+    Fetch every section of the named configs into the section cache, so the
+    emails built from them shortly after are served from it.
+    """
+    configs = {config_name: get_config(config_name) for config_name in config_names}
+    wanted = {
+        name: config.get("sections", DEFAULT_SECTIONS)
+        for name, config in configs.items()
+    }
+    with metrics.timer("section_cache_warm"):
+        data = fetch_sections_data(configs, wanted)
+    warmed = sum(len(sections_data) for sections_data in data.values())
+    log.info(f"{warmed} sections of {len(configs)} configs warmed")
+    return warmed
+
+
+def section_placeholder(title):
+    return f"<i>{title} unavailable right now.</i><br><hr>"
+
+
+def render_weather(weather):
+    return render_cache.get_or_render(
+        "weather",
+        tuple((area, doc_key(doc), doc["time"]) for area, doc in weather.items()),
+        weather_to_html,
+        weather,
+    )
+
+
+def render_current_events(current_events):
+    if current_events is None:
+        current_events_key = None
+    else:
+        content = current_events.get("_hash", current_events["text"])
+        current_events_key = (doc_key(current_events), content)
+    return render_cache.get_or_render(
+        "current events",
+        current_events_key,
+        current_events_to_html,
+        current_events,
+    )
+
+
+def render_news(news):
+    return render_cache.get_or_render(
+        "news",
+        tuple(doc_key(article) for article in news),
+        news_to_html,
+        news,
+    )
+
+
+def render_tweets(tweets):
+    return render_cache.get_or_render(
+        "twitter",
+        tuple(doc_key(tweet) for tweet in tweets),
+        tweets_to_html,
+        tweets,
+    )
+
+
+# Email order, (title, renderer, whether the section needs a title header)
+SECTION_RENDERERS = {
+    "weather": ("Weather", render_weather, True),
+    "travel": ("Journey Time", journey_info_to_html, True),
+    "current_events": ("Current Events", render_current_events, False),
+    "twitter": ("Travel Updates", render_tweets, True),
+    "news": ("Latest Headlines", render_news, True),
+}
+
+
+def create_email_html_body(config_name="default", **config):
+    """
+    Sections come from config["sections"] (default weather, current_events and
+    news; twitter and travel can be added) and are fetched concurrently, each
+    bounded by config["section_timeout"] seconds.
+    """
+    with metrics.timer("build_email", config=config_name):
+        return _create_email_html_bodies({config_name: config})[config_name]
+
+
+def create_email_html_bodies(configs):
+    """
+    Build the email for each of {config_name: config} with a single round of
+    queries for the whole batch, returns {config_name: html}.
+    """
+    with metrics.timer("build_email_batch"):
+        return _create_email_html_bodies(configs)
+
+
+def _create_email_html_bodies(configs):
+    data = get_sections_data(configs)
+    return {
+        name: render_email(name, config, data[name]) for name, config in configs.items()
+    }
+
+
+def render_email(config_name, config, data):
+    sections = config.get("sections", DEFAULT_SECTIONS)
+    body = []
+    for section, (title, render, with_header) in SECTION_RENDERERS.items():
+        if section not in sections:
+            continue
+        if with_header:
+            body.append(f'<h2 style="font-size:20px;">{title}</h2> <br>')
+        if section in data:
+            with metrics.timer("render", section=section, config=config_name):
+                body.append(f"{render(data[section])} <br>")
+        else:
+            body.append(f"{section_placeholder(title)} <br>")
+    body = "\n              ".join(body)
 
     html = f"""
         <html>
           <body>
             <p style="color:black;">
-              <h2 style="font-size:20px;">Weather</h2> <br>
-              {weather_html} <br>
-              {current_events_html} <br>
-              <h2 style="font-size:20px;">Latest Headlines</h2> <br>
-              {news_html} <br>
+              {body}
             </p>
           </body>
         </html>
@@ -153,42 +499,135 @@ def create_email_html_body(**config):
     return html
 
 
-def send_email(html, use_ses=True):
-    email_credentials = get_email_credentials()
-    receiver_email = email_credentials["receiver_email"]
-    sender_email = email_credentials["sender_email"]
+def build_message(html, sender_email, receiver_email):
     message = MIMEMultipart("alternative")
     message["Subject"] = f"UPDATE - {datetime.now().strftime('%a %d %b %y')}"
     html_main = MIMEText(html, "html")
     message["From"] = sender_email
     message["To"] = receiver_email
     message.attach(html_main)
-    password = email_credentials["sender_password"]
-    context = ssl.create_default_context()
-    if use_ses:
-        aws_ses_credentials = get_aws_ses_credentials()
-        smtp_username = aws_ses_credentials["smtp-username"]
-        smtp_password = aws_ses_credentials["smtp-password"]
-        with smtplib.SMTP("email-smtp.eu-west-2.amazonaws.com", port=587) as server:
+    return message
+
+
+class EmailSender:
+    """
+    Keeps one authenticated SMTP connection open across many messages,
+    reconnecting if the server drops it. Use as a context manager:
+
+        with EmailSender() as sender:
+            sender.send(html, "someone@example.com")
+    """
+
+    ses_host = "email-smtp.eu-west-2.amazonaws.com"
+    gmail_host = "smtp.gmail.com"
+    port = 587
+
+    def __init__(self, use_ses=True):
+        self.use_ses = use_ses
+        self.email_credentials = get_email_credentials()
+        self.sender_email = self.email_credentials["sender_email"]
+        if use_ses:
+            self.aws_ses_credentials = get_aws_ses_credentials()
+        self._server = None
+
+    def connect(self):
+        if self.use_ses:
+            server = smtplib.SMTP(self.ses_host, port=self.port)
             server.starttls()
-            server.login(smtp_username, smtp_password)
-            log.info("sending message")
-            server.send_message(message, sender_email, receiver_email)
-            log.info("message sent")
-            return
+            server.login(
+                self.aws_ses_credentials["smtp-username"],
+                self.aws_ses_credentials["smtp-password"],
+            )
+        else:
+            context = ssl.create_default_context()
+            server = smtplib.SMTP_SSL(self.gmail_host, port=self.port, context=context)
+            server.login(self.sender_email, self.email_credentials["sender_password"])
+        self._server = server
+        log.info("SMTP connection established")
+        return server
 
-    else:
-        with smtplib.SMTP_SSL("smtp.gmail.com", port=587, context=context) as server:
-            server.login(sender_email, password)
-            log.info("sending message")
-            server.send_message(message, sender_email, receiver_email)
-    log.info("message sent")
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self._server = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send(self, html, receiver_email=None):
+        if receiver_email is None:
+            receiver_email = self.email_credentials["receiver_email"]
+        message = build_message(html, self.sender_email, receiver_email)
+        if self._server is None:
+            self.connect()
+        log.info("sending message")
+        with metrics.timer("smtp_send"):
+            try:
+                self._server.send_message(message, self.sender_email, receiver_email)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                # 421 is the server closing the session, e.g. on an idle timeout
+                if getattr(e, "smtp_code", 421) != 421:
+                    raise
+                log.info(f"SMTP connection dropped ({e!r}), reconnecting")
+                metrics.inc("smtp_reconnects_total")
+                self._server.close()
+                self.connect()
+                self._server.send_message(message, self.sender_email, receiver_email)
+        metrics.inc("emails_sent_total")
+        log.info("message sent")
+
+
+def send_email(html, use_ses=True, receiver_email=None):
+    with EmailSender(use_ses=use_ses) as sender:
+        sender.send(html, receiver_email)
+    return
+
+
+def get_config(config_name):
+    return load_config_json(config_name)
+
+
+def send_emails(recipients, use_ses=True, sender_class=EmailSender):
+    """
+    Send to every recipient over a single SMTP session. Each recipient is a
+    dict like {"receiver_email": "someone@example.com", "config": "morning.json"}.
+    Bodies for all distinct configs are built together, so data shared by
+    several configs is queried once.
+    """
+    config_names = dict.fromkeys(recipient["config"] for recipient in recipients)
+    html_bodies = create_email_html_bodies(
+        {config_name: get_config(config_name) for config_name in config_names}
+    )
+    failed = 0
+    with sender_class(use_ses=use_ses) as sender:
+        for recipient in recipients:
+            receiver_email = recipient["receiver_email"]
+            try:
+                sender.send(html_bodies[recipient["config"]], receiver_email)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                # one bad address or rejected message should not stop the rest
+                log.error(f"sending to {receiver_email} failed: {e!r}")
+                metrics.inc("emails_failed_total")
+                failed += 1
+    log.info(f"{len(recipients) - failed} messages sent, {failed} failed")
     return
 
 
 if __name__ == "__main__":
     args = sys.argv[1:]
     args = dict([arg.split("=") for arg in args])
+    if "recipients" in args:
+        log.info(f"recipients: {args['recipients']}")
+        send_emails(get_config(args["recipients"]))
+        metrics.export("emailer")
+        sys.exit(0)
     try:
         config_name = args["config"]
     except KeyError:
@@ -196,7 +635,7 @@ if __name__ == "__main__":
             "You need to pass a command line argument e.g. config=morning.json"
         )
     log.info(f"config: {config_name}")
-    with open(f"./configs/{config_name}", "r") as f:
-        config = json.loads(f.read())
-    html = create_email_html_body(**config)
+    config = get_config(config_name)
+    html = create_email_html_body(config_name, **config)
     send_email(html)
+    metrics.export("emailer")
@@ -0,0 +1,348 @@
+import logging as log
+import sys
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+import pymongo
+import pytz
+
+from met_office_utils import (
+    CARDINAL_DECISION_POINTS,
+    CARDINAL_DIRECTIONS,
+    get_timesteps_collection,
+)
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+LONDON = pytz.timezone("Europe/London")
+EPOCH = datetime(1970, 1, 1)
+MPS_TO_MPH = 2.23694
+
+FIELDS = (
+    "screenTemperature",
+    "maxScreenAirTemp",
+    "minScreenAirTemp",
+    "screenDewPointTemperature",
+    "feelsLikeTemperature",
+    "windSpeed10m",
+    "windDirectionFrom10m",
+    "windGustSpeed10m",
+    "max10mWindGust",
+    "visibility",
+    "screenRelativeHumidity",
+    "mslp",
+    "uvIndex",
+    "precipitationRate",
+    "totalPrecipAmount",
+    "totalSnowAmount",
+    "probOfPrecipitation",
+)
+# averaged and interpolated on the unit circle so 350 and 10 meet at 0
+CIRCULAR_FIELDS = ("windDirectionFrom10m",)
+
+
+def to_minutes(ts):
+    """Minutes since the epoch of a "%Y-%m-%dT%H:%MZ" string or a UTC datetime"""
+    if isinstance(ts, str):
+        ts = datetime.strptime(ts, "%Y-%m-%dT%H:%MZ")
+    elif ts.tzinfo is not None:
+        ts = ts.astimezone(pytz.utc).replace(tzinfo=None)
+    return (ts - EPOCH) // timedelta(minutes=1)
+
+
+def local_to_minutes(day, clock):
+    """Minutes since the epoch of the London wall clock time `clock` on `day`"""
+    local = LONDON.localize(datetime.combine(day, clock))
+    return to_minutes(local)
+
+
+def utc_offsets(minutes):
+    """Europe/London UTC offset in minutes, resolved once per distinct hour"""
+    hours, inverse = np.unique(np.asarray(minutes) // 60, return_inverse=True)
+    offsets = np.array(
+        [
+            pytz.utc.localize(EPOCH + timedelta(hours=int(hour)))
+            .astimezone(LONDON)
+            .utcoffset()
+            // timedelta(minutes=1)
+            for hour in hours
+        ],
+        dtype=np.int64,
+    )
+    return offsets[inverse.reshape(-1)].reshape(np.shape(minutes))
+
+
+def format_local(minutes):
+    """Vectorized utc_to_gmt: "%Y-%m-%d %H:%M:%S" London time strings"""
+    minutes = np.asarray(minutes, dtype=np.int64)
+    local = (minutes + utc_offsets(minutes)).astype("datetime64[m]")
+    return np.char.add(
+        np.char.replace(np.datetime_as_string(local, unit="m"), "T", " "), ":00"
+    )
+
+
+def mps_to_mph(speed):
+    return np.asarray(speed, dtype=float) * MPS_TO_MPH
+
+
+def cardinals(bearings):
+    """Vectorized bearing_to_cardinal, None where the bearing is missing"""
+    bearings = np.asarray(bearings, dtype=float)
+    index = np.searchsorted(CARDINAL_DECISION_POINTS, bearings, side="right")
+    names = np.array(CARDINAL_DIRECTIONS + ["North"], dtype=object)[
+        np.minimum(index, len(CARDINAL_DIRECTIONS))
+    ]
+    names[(bearings < 0) | (bearings > 360)] = "Invalid bearing value"
+    names[np.isnan(bearings)] = None
+    return names
+
+
+def _circular_mean(sin_sum, cos_sum):
+    # rounded first so a mean a hair below 0 comes out as 0, not 360
+    return np.round(np.rad2deg(np.arctan2(sin_sum, cos_sum)), 6) % 360
+
+
+class Forecast:
+    """
+    One area's forecast as columns: `minutes` holds the forecast times in
+    minutes since the epoch (UTC, ascending) and `data` is a (field, time)
+    float matrix in FIELDS order, NaN where a datapoint had no value.
+    `issues` holds the modelRunDate each timestep came from.
+    """
+
+    def __init__(self, area, minutes, data, issues=None):
+        self.area = area
+        self.minutes = minutes
+        self.data = data
+        if issues is None:
+            issues = np.full(len(minutes), None, dtype=object)
+        self.issues = issues
+
+    @classmethod
+    def from_datapoints(cls, area, datapoints):
+        datapoints = sorted(datapoints, key=lambda d: d["time"])
+        minutes = np.array([to_minutes(d["time"]) for d in datapoints], dtype=np.int64)
+        data = np.array(
+            [
+                [np.nan if d.get(field) is None else d[field] for d in datapoints]
+                for field in FIELDS
+            ],
+            dtype=float,
+        ).reshape(len(FIELDS), len(datapoints))
+        issues = np.array([d.get("modelRunDate") for d in datapoints], dtype=object)
+        return cls(area, minutes, data, issues)
+
+    def __len__(self):
+        return len(self.minutes)
+
+    @property
+    def values(self):
+        return dict(zip(FIELDS, self.data))
+
+    def at(self, when):
+        """
+        Every field linearly interpolated to `when` (minutes since the epoch,
+        scalar or array), NaN outside the forecast.
+        """
+        when = np.asarray(when, dtype=float)
+        if not len(self):
+            return {field: np.full(when.shape, np.nan) for field in FIELDS}
+        x = self.minutes.astype(float)
+
+        def interp(column):
+            return np.interp(when, x, column, left=np.nan, right=np.nan)
+
+        interpolated = {}
+        for field, column in self.values.items():
+            if field in CIRCULAR_FIELDS:
+                radians = np.deg2rad(column)
+                interpolated[field] = _circular_mean(
+                    interp(np.sin(radians)), interp(np.cos(radians))
+                )
+            else:
+                interpolated[field] = interp(column)
+        return interpolated
+
+    def issues_at(self, when):
+        """modelRunDates of the timesteps `when` is interpolated between"""
+        before = np.searchsorted(self.minutes, when, side="right") - 1
+        after = np.searchsorted(self.minutes, when, side="left")
+        indexes = {i for i in (before, after) if 0 <= i < len(self)}
+        return sorted({self.issues[i] for i in indexes if self.issues[i] is not None})
+
+    def windows(self, starts, ends):
+        """
+        min, max and mean of every field over each [start, end] window (minutes
+        since the epoch), as {field: {"min": array, "max": array, "mean": array}}.
+        Windows without datapoints get NaN.
+        """
+        starts = np.atleast_1d(np.asarray(starts, dtype=np.int64))
+        ends = np.atleast_1d(np.asarray(ends, dtype=np.int64))
+        lo = np.searchsorted(self.minutes, starts, side="left")
+        hi = np.searchsorted(self.minutes, ends, side="right")
+        empty = hi <= lo
+        # reduceat reduces data[:, lo:hi] for each (lo, hi) pair of the
+        # interleaved bounds, the padding keeps hi == len(self) a valid index
+        bounds = np.stack([lo, hi], axis=1).reshape(-1)
+        padded = np.pad(self.data, ((0, 0), (0, 1)), constant_values=np.nan)
+
+        def reduce(ufunc):
+            result = ufunc.reduceat(padded, bounds, axis=1)[:, ::2]
+            result[:, empty] = np.nan
+            return result
+
+        def window_means(data):
+            present = ~np.isnan(data)
+            zeros = np.zeros((len(data), 1))
+            total = np.hstack([zeros, np.cumsum(np.where(present, data, 0), axis=1)])
+            count = np.hstack([zeros, np.cumsum(present, axis=1)])
+            count = count[:, hi] - count[:, lo]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = (total[:, hi] - total[:, lo]) / count
+            return np.where(count > 0, mean, np.nan)
+
+        minimum, maximum = reduce(np.fmin), reduce(np.fmax)
+        mean = window_means(self.data)
+        for i, field in enumerate(FIELDS):
+            if field in CIRCULAR_FIELDS:
+                radians = np.deg2rad(self.data[i])
+                unit = np.stack([np.sin(radians), np.cos(radians)])
+                mean[i] = _circular_mean(*window_means(unit))
+        return {
+            field: {"min": minimum[i], "max": maximum[i], "mean": mean[i]}
+            for i, field in enumerate(FIELDS)
+        }
+
+    def window(self, start, end):
+        """windows() for a single window, as plain floats"""
+        return {
+            field: {stat: float(values[0]) for stat, values in stats.items()}
+            for field, stats in self.windows([start], [end]).items()
+        }
+
+
+def load_forecasts(areas, start=None, end=None):
+    """
+    {area: Forecast} built from the newest issue of every timestep of `areas`,
+    optionally limited to forecast times within [start, end] (UTC datetimes).
+    """
+    query = {"_area": {"$in": list(areas)}}
+    if start is not None or end is not None:
+        query["time"] = {}
+        if start is not None:
+            query["time"]["$gte"] = start.strftime("%Y-%m-%dT%H:%MZ")
+        if end is not None:
+            query["time"]["$lte"] = end.strftime("%Y-%m-%dT%H:%MZ")
+    projection = {"_id": 0, "_area": 1, "time": 1, "modelRunDate": 1}
+    projection.update({field: 1 for field in FIELDS})
+    cursor = (
+        get_timesteps_collection()
+        .find(query, projection)
+        .sort(
+            [
+                ("_area", pymongo.ASCENDING),
+                ("time", pymongo.ASCENDING),
+                ("modelRunDate", pymongo.DESCENDING),
+            ]
+        )
+    )
+    newest = {}
+    for doc in cursor:
+        newest.setdefault((doc["_area"], doc["time"]), doc)
+    datapoints = {area: [] for area in areas}
+    for (area, _), doc in newest.items():
+        datapoints[area].append(doc)
+    return {
+        area: Forecast.from_datapoints(area, docs) for area, docs in datapoints.items()
+    }
+
+
+def parse_clock(value):
+    """A weather config time, either a whole hour (8) or "HH:MM" ("08:30")"""
+    if isinstance(value, int):
+        return time(value)
+    return datetime.strptime(value, "%H:%M").time()
+
+
+def interpolate_datapoints(area_clocks, day=None):
+    """
+    Forecast for each (area, clock) pair at any minute of `day` (default
+    today), interpolated between the surrounding timesteps. Returns
+    {(area, clock): datapoint} in the shape of query_met_office_datapoints.
+    """
+    if not area_clocks:
+        return {}
+    day = day or date.today()
+    area_clocks = list(dict.fromkeys(area_clocks))
+    when = np.array(
+        [local_to_minutes(day, parse_clock(clock)) for _, clock in area_clocks],
+        dtype=np.int64,
+    )
+    # hourly timesteps, an hour either side brackets every requested minute
+    forecasts = load_forecasts(
+        {area for area, _ in area_clocks},
+        start=EPOCH + timedelta(minutes=int(when.min()) - 60),
+        end=EPOCH + timedelta(minutes=int(when.max()) + 60),
+    )
+    local_times = format_local(when)
+    datapoints = {}
+    for i, (area, clock) in enumerate(area_clocks):
+        values = forecasts[area].at(when[i])
+        if np.isnan(values["screenTemperature"]):
+            continue
+        datapoint = {
+            field: None if np.isnan(value) else round(float(value), 2)
+            for field, value in values.items()
+        }
+        if datapoint["probOfPrecipitation"] is not None:
+            datapoint["probOfPrecipitation"] = round(datapoint["probOfPrecipitation"])
+        datapoint["time"] = str(local_times[i])
+        # like a timestep _id, so the render cache sees a newer issue
+        datapoint["_id"] = "|".join(
+            [area, datapoint["time"], *forecasts[area].issues_at(when[i])]
+        )
+        datapoints[(area, clock)] = datapoint
+    return datapoints
+
+
+def summarise(areas, start, end, days=1, first_day=None):
+    """
+    min, max and mean of every field between the London wall clock times
+    `start` and `end` ("HH:MM") on each of `days` days from `first_day`
+    (default today). Returns {area: {field: {"min", "max", "mean"}}} with one
+    value per day in each array.
+    """
+    first_day = first_day or date.today()
+    days = [first_day + timedelta(days=i) for i in range(days)]
+    start, end = parse_clock(start), parse_clock(end)
+    starts = np.array([local_to_minutes(day, start) for day in days], dtype=np.int64)
+    ends = np.array([local_to_minutes(day, end) for day in days], dtype=np.int64)
+    forecasts = load_forecasts(
+        areas,
+        start=EPOCH + timedelta(minutes=int(starts.min())),
+        end=EPOCH + timedelta(minutes=int(ends.max())),
+    )
+    return {
+        area: forecast.windows(starts, ends) for area, forecast in forecasts.items()
+    }
+
+
+if __name__ == "__main__":
+    kwargs = dict([arg.split("=") for arg in sys.argv[1:]])
+    areas = kwargs["areas"].split(",")
+    days = int(kwargs.get("days", 1))
+    summaries = summarise(
+        areas, kwargs.get("start", "07:00"), kwargs.get("end", "09:00"), days=days
+    )
+    for area, summary in summaries.items():
+        temperature = summary["screenTemperature"]
+        wind = summary["windSpeed10m"]
+        direction = cardinals(summary["windDirectionFrom10m"]["mean"])
+        rain = summary["probOfPrecipitation"]["max"]
+        for i in range(days):
+            log.info(
+                f"{area} day {i}: {temperature['min'][i]:.1f}-"
+                f"{temperature['max'][i]:.1f}C, wind "
+                f"{mps_to_mph(wind['mean'][i]):.1f} mph from the {direction[i]}, "
+                f"rain up to {rain[i]:.0f}%"
+            )
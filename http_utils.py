@@ -0,0 +1,257 @@
+import logging as log
+import random
+import threading
+from time import monotonic, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# timeout: (connect, read) seconds per attempt
+# budget: seconds allowed for all attempts including backoff sleeps
+# failure_threshold/reset_after: consecutive failures before the circuit opens,
+# and seconds before a single trial request is let through again
+# quota: (calls, per_seconds) allowed by the upstream plan, set to your own plan
+ENDPOINTS = {
+    "met-office": {
+        "timeout": (3.05, 5),
+        "max_attempts": 3,
+        "budget": 20,
+        "failure_threshold": 5,
+        "reset_after": 60,
+        "quota": (360, 24 * 60 * 60),
+    },
+    "citymapper": {
+        "timeout": (3.05, 3),
+        "max_attempts": 2,
+        "budget": 6,
+        "failure_threshold": 5,
+        "reset_after": 60,
+        "quota": (1000, 24 * 60 * 60),
+    },
+    "wiki": {
+        "timeout": (3.05, 15),
+        "max_attempts": 3,
+        "budget": 45,
+        "failure_threshold": 5,
+        "reset_after": 120,
+    },
+    "twitter": {
+        "timeout": (3.05, 20),
+        "max_attempts": 3,
+        "budget": 60,
+        "failure_threshold": 5,
+        "reset_after": 120,
+        "quota": (900, 15 * 60),
+    },
+    "newsapi": {
+        "timeout": (3.05, 30),
+        "max_attempts": 3,
+        "budget": 90,
+        "failure_threshold": 5,
+        "reset_after": 300,
+        "quota": (100, 24 * 60 * 60),
+    },
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class QuotaExhaustedError(requests.exceptions.RequestException):
+    pass
+
+
+class TokenBucket:
+    """
+    Allows `calls` calls per `per_seconds`, refilled continuously, so a call
+    over quota is refused locally instead of being spent on an error.
+    """
+
+    def __init__(self, name, calls, per_seconds):
+        self.name = name
+        self.capacity = calls
+        self.rate = calls / per_seconds
+        self.tokens = float(calls)
+        self.spent = 0
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n=1):
+        with self._lock:
+            self._refill()
+            if self.tokens < n:
+                metrics.inc("quota_rejections_total", endpoint=self.name)
+                raise QuotaExhaustedError(f"quota for {self.name} exhausted")
+            self.tokens -= n
+            self.spent += n
+
+    def seconds_until(self, n=1):
+        """Seconds until n calls are available"""
+        with self._lock:
+            self._refill()
+            return max(min(n, self.capacity) - self.tokens, 0) / self.rate
+
+    def drain(self):
+        """The upstream says we are over quota, stop calling until it refills"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                log.warning(f"{self.name} rate limited upstream, draining its quota")
+            self.tokens = 0.0
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, rejecting calls
+    for `reset_after` seconds before letting a trial call through.
+    """
+
+    def __init__(self, name, failure_threshold, reset_after):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if monotonic() - self.opened_at < self.reset_after:
+                metrics.inc("circuit_rejections_total", endpoint=self.name)
+                raise CircuitOpenError(f"circuit for {self.name} is open")
+            # half open, let this call through as a trial
+            self.opened_at = monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log.warning(f"circuit for {self.name} opened")
+                self.opened_at = monotonic()
+
+
+_sessions = {}
+_breakers = {}
+_quotas = {}
+_lock = threading.Lock()
+
+
+def get_session(endpoint):
+    """Keep-alive session with a connection pool, one per endpoint"""
+    with _lock:
+        if endpoint not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[endpoint] = session
+        return _sessions[endpoint]
+
+
+def get_breaker(endpoint):
+    with _lock:
+        if endpoint not in _breakers:
+            settings = ENDPOINTS[endpoint]
+            _breakers[endpoint] = CircuitBreaker(
+                endpoint, settings["failure_threshold"], settings["reset_after"]
+            )
+        return _breakers[endpoint]
+
+
+def get_quota(endpoint):
+    """The endpoint's TokenBucket, None if it has no quota"""
+    settings = ENDPOINTS.get(endpoint, {})
+    if "quota" not in settings:
+        return None
+    with _lock:
+        if endpoint not in _quotas:
+            _quotas[endpoint] = TokenBucket(endpoint, *settings["quota"])
+        return _quotas[endpoint]
+
+
+def acquire_quota(endpoint, n=1):
+    """Spend n calls of the endpoint's quota, raises QuotaExhaustedError"""
+    quota = get_quota(endpoint)
+    if quota is not None:
+        quota.acquire(n)
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def call_with_retry(endpoint, func, *args, **kwargs):
+    """
+    Call func with the endpoint's retry policy, retrying connection errors,
+    timeouts and responses with a status in RETRY_STATUSES. Used directly for
+    SDK calls and by `request` for plain HTTP.
+    """
+    settings = ENDPOINTS[endpoint]
+    breaker = get_breaker(endpoint)
+    deadline = monotonic() + settings["budget"]
+    attempt = 0
+    while True:
+        breaker.before_call()
+        acquire_quota(endpoint)
+        try:
+            result = func(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            breaker.record_failure()
+            metrics.inc("http_errors_total", endpoint=endpoint, error=type(e).__name__)
+            error = e
+        else:
+            status = getattr(result, "status_code", None)
+            if status is not None:
+                metrics.inc("http_responses_total", endpoint=endpoint, status=status)
+            if status not in RETRY_STATUSES:
+                breaker.record_success()
+                return result
+            if status == 429 and get_quota(endpoint) is not None:
+                get_quota(endpoint).drain()
+            breaker.record_failure()
+            error = None
+
+        attempt += 1
+        delay = backoff_delay(attempt)
+        if attempt >= settings["max_attempts"] or monotonic() + delay > deadline:
+            if error is not None:
+                raise error
+            return result
+        log.info(f"{endpoint}: attempt {attempt} failed, retrying in {delay:.2f}s")
+        metrics.inc("http_retries_total", endpoint=endpoint)
+        sleep(delay)
+
+
+def request(endpoint, method, url, **kwargs):
+    """requests.Session.request over the endpoint's pooled session and retries"""
+    kwargs.setdefault("timeout", ENDPOINTS[endpoint]["timeout"])
+    session = get_session(endpoint)
+    with metrics.timer("http_fetch", endpoint=endpoint):
+        return call_with_retry(endpoint, session.request, method, url, **kwargs)
+
+
+def get(endpoint, url, **kwargs):
+    return request(endpoint, "GET", url, **kwargs)
@@ -1,33 +1,37 @@
-import json
 import logging as log
-import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time
 
 import pymongo
 import pytz
-import requests
 
-log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+from config_utils import load_key_json
+from mongo_utils import ensure_index, get_collection
 
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def get_met_office_credentials():
-    home = os.path.expanduser("~")
-    with open(f"{home}/keys/met-office/auth.json", "r") as f:
-        credentials = json.load(f)
-    return credentials
+CARDINAL_DIRECTIONS = [
+    "North",
+    "North East",
+    "East",
+    "South East",
+    "South",
+    "South West",
+    "West",
+    "North West",
+]
+CARDINAL_DECISION_POINTS = [
+    180 / len(CARDINAL_DIRECTIONS) + 45 * i for i in range(len(CARDINAL_DIRECTIONS))
+]
 
 
-def get_location_config(area=None):
-    with open(f"./configs/location.json", "r") as f:
-        location = json.loads(f.read())
-    if area is None:
-        return location
-    else:
-        return location[area]
+def get_met_office_credentials():
+    return load_key_json("met-office", "auth.json")
 
 
-def get_met_office_weather(latitude, longitude):
-    credentials = get_met_office_credentials()
+def get_met_office_weather(latitude, longitude, credentials=None):
+    if credentials is None:
+        credentials = get_met_office_credentials()
     url = "https://api-metoffice.apiconnect.ibmcloud.com/metoffice/production/v0/forecasts/point/hourly"
 
     headers = {"accept": "application/json", **credentials}
@@ -41,11 +45,40 @@ def get_met_office_weather(latitude, longitude):
         "longitude": longitude,
     }
 
-    r = requests.get(url, headers=headers, params=params, timeout=1)
+    import http_utils
+
+    r = http_utils.get("met-office", url, headers=headers, params=params)
     r.raise_for_status()
     return r.json()
 
 
+def get_met_office_weather_batch(locations, max_workers=None):
+    """
+    Fetch forecasts for many areas concurrently over the pooled session.
+    `locations` maps area name to {"latitude": ..., "longitude": ...}.
+    Returns {area: forecast}, areas whose request failed are logged and left out.
+    """
+    import requests
+
+    credentials = get_met_office_credentials()
+    areas = list(locations)
+    if max_workers is None:
+        max_workers = len(areas)
+
+    def fetch(area):
+        return get_met_office_weather(**locations[area], credentials=credentials)
+
+    forecasts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {area: executor.submit(fetch, area) for area in areas}
+        for area, future in futures.items():
+            try:
+                forecasts[area] = future.result()
+            except requests.exceptions.RequestException as e:
+                log.warning(f"Met Office request for {area} failed: {e!r}")
+    return forecasts
+
+
 def utc_to_gmt(ts):
     ts = datetime.strptime(ts, "%Y-%m-%dT%H:%MZ")
     utc = pytz.timezone("UTC")
@@ -65,49 +98,105 @@ def bearing_to_cardinal(bearing):
         return None
     if not 0 <= bearing <= 360:
         return "Invalid bearing value"
-    cardinal_directions = [
-        "North",
-        "North East",
-        "East",
-        "South East",
-        "South",
-        "South West",
-        "West",
-        "North West",
-    ]
-    decision_points = [
-        180 / len(cardinal_directions) + 45 * i for i in range(len(cardinal_directions))
-    ]
-    for i, boundary in enumerate(decision_points):
+    for i, boundary in enumerate(CARDINAL_DECISION_POINTS):
         if boundary > bearing:
-            return cardinal_directions[i]
+            return CARDINAL_DIRECTIONS[i]
     return "North"
 
 
-def query_met_office_prediction(**kwargs):
-    """Argument is main config"""
+def get_timesteps_collection():
+    collection = get_collection("metoffice", "timesteps")
+    ensure_index(
+        collection,
+        [
+            ("_area", pymongo.ASCENDING),
+            ("time", pymongo.ASCENDING),
+            ("modelRunDate", pymongo.DESCENDING),
+        ],
+    )
+    return collection
+
+
+def flatten_forecast(weather, area):
+    """One document per (area, forecast time, issue time) of a forecast response"""
+    properties = weather["features"][0]["properties"]
+    model_run_date = properties.get("modelRunDate")
+    ingested_at = datetime.utcnow()
+    docs = []
+    for datapoint in properties["timeSeries"]:
+        doc = dict(datapoint)
+        doc["_id"] = f"{area}|{datapoint['time']}|{model_run_date}"
+        doc["_area"] = area
+        doc["modelRunDate"] = model_run_date
+        doc["_ingested_at"] = ingested_at
+        docs.append(doc)
+    return docs
+
+
+def query_met_office_datapoints(area_hours):
+    """
+    Newest forecast datapoint for each (area, hour) pair, fetched in one
+    indexed query. Returns {(area, hour): datapoint}, missing pairs are left out.
+    Hours given as "HH:MM" are interpolated between the surrounding timesteps.
+    """
+    area_hours = set(area_hours)
+    clocks = {(area, hour) for area, hour in area_hours if not isinstance(hour, int)}
+    datapoints = {}
+    if clocks:
+        # numpy is only needed for times between whole hours
+        from forecast_utils import interpolate_datapoints
+
+        datapoints = interpolate_datapoints(clocks)
+    timestamps = {
+        (area, hour): get_weather_timestamp(hour) for area, hour in area_hours - clocks
+    }
+    if not timestamps:
+        return datapoints
+    keys = [{"_area": area, "time": ts} for (area, _), ts in timestamps.items()]
+    pipeline = [
+        {"$match": {"$or": keys}},
+        {"$sort": {"modelRunDate": -1}},
+        {
+            "$group": {
+                "_id": {"_area": "$_area", "time": "$time"},
+                "doc": {"$first": "$$ROOT"},
+            }
+        },
+    ]
+    found = {}
+    for result in get_timesteps_collection().aggregate(pipeline):
+        datapoint = result["doc"]
+        area = datapoint.pop("_area")
+        ts = datapoint["time"]
+        datapoint.pop("modelRunDate")
+        datapoint.pop("_ingested_at", None)
+        datapoint["time"] = utc_to_gmt(ts)
+        found[(area, ts)] = datapoint
+    for key, ts in timestamps.items():
+        if (key[0], ts) in found:
+            datapoints[key] = dict(found[(key[0], ts)])
+    return datapoints
+
+
+def predictions_for(weather_config, datapoints):
+    """{area: datapoint} for a config's weather list from query_met_office_datapoints"""
     predictions = {}
-    client = pymongo.MongoClient()
-    db = client["metoffice"]
-    collection = db["hourly"]
-    weather_config = kwargs["weather"]
     for cfg in weather_config:
-        area, hour = tuple(cfg.items())[0]
-        timestamp = get_weather_timestamp(hour)
-        latest_predictions = collection.find_one(
-            filter={"_area": area}, sort=[("_id", -1)]
-        )
-        if not latest_predictions:
+        key = tuple(cfg.items())[0]
+        if key in datapoints:
+            predictions[key[0]] = datapoints[key]
+        else:
             log.info(
-                f"No predictions found, check you have data for the provided {area}"
+                f"No predictions found, check you have data for the provided {key[0]}"
             )
-            return predictions
-        time_series = latest_predictions["features"][0]["properties"]["timeSeries"]
-        for datapoint in time_series:
-            if datapoint["time"] == timestamp:
-                predictions[area] = datapoint
-                predictions[area]["time"] = utc_to_gmt(predictions[area]["time"])
     log.info(
         f"expected {len(weather_config)} weather predictions, got {len(predictions)} weather predictions"
     )
     return predictions
+
+
+def query_met_office_prediction(**kwargs):
+    """Argument is main config"""
+    weather_config = kwargs["weather"]
+    area_hours = [tuple(cfg.items())[0] for cfg in weather_config]
+    return predictions_for(weather_config, query_met_office_datapoints(area_hours))
@@ -0,0 +1,170 @@
+import json
+import logging as log
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+PREFIX = "email_service"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+
+class Registry:
+    """
+    In-process counters and timing histograms, keyed by metric name and a
+    sorted tuple of label pairs.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Time the block as email_service_stage_seconds{stage=..., **labels}"""
+        start = perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            self.observe("stage_seconds", elapsed, stage=stage, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render_prometheus(self):
+        """Prometheus text exposition format"""
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {PREFIX}_{name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{PREFIX}_{name}{fmt(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}_{name} histogram")
+                for (metric, labels), hist in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.bucket_counts):
+                        cumulative += count
+                        le = fmt(labels, [("le", bound)])
+                        lines.append(f"{PREFIX}_{name}_bucket{le} {cumulative}")
+                    le = fmt(labels, [("le", "+Inf")])
+                    lines.append(f"{PREFIX}_{name}_bucket{le} {hist.count}")
+                    lines.append(f"{PREFIX}_{name}_sum{fmt(labels)} {hist.sum}")
+                    lines.append(f"{PREFIX}_{name}_count{fmt(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": hist.count,
+                    "sum": round(hist.sum, 6),
+                    "mean": round(hist.sum / hist.count, 6),
+                    "p50": hist.quantile(0.5),
+                    "p95": hist.quantile(0.95),
+                    "max": round(hist.max, 6),
+                }
+                for (name, labels), hist in sorted(self.histograms.items())
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+def export(run, metrics_dir=None):
+    """
+    Write {run}.prom (for a textfile collector to scrape) and {run}.json into
+    METRICS_DIR (default ./metrics) and log the JSON summary.
+    """
+    if metrics_dir is None:
+        metrics_dir = os.environ.get("METRICS_DIR", "./metrics")
+    os.makedirs(metrics_dir, exist_ok=True)
+    summary = registry.summary()
+    prom_path = os.path.join(metrics_dir, f"{run}.prom")
+    _write_atomic(prom_path, registry.render_prometheus())
+    json_path = os.path.join(metrics_dir, f"{run}.json")
+    _write_atomic(json_path, json.dumps(summary, indent=4))
+    log.info(f"metrics summary: {json.dumps(summary)}")
+    return summary
+
+
+def _write_atomic(path, content):
+    """
+    Write then rename so a scraper never reads a half written file, and
+    exports from parallel jobs never interleave
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
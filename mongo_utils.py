@@ -0,0 +1,87 @@
+import logging as log
+import os
+import threading
+
+import pymongo
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+_client = None
+_client_lock = threading.Lock()
+_ensured_indexes = set()
+
+
+def get_mongo_settings():
+    """Client settings, overridable with MONGO_* environment variables"""
+    return {
+        "host": os.environ.get("MONGO_URI", "mongodb://localhost:27017"),
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 20)),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS": int(
+            os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)
+        ),
+        "socketTimeoutMS": int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+    }
+
+
+def get_client():
+    """Process-wide MongoClient, created on first use and shared by all modules"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                settings = get_mongo_settings()
+                _client = pymongo.MongoClient(**settings)
+                log.info(
+                    f"MongoClient created with maxPoolSize={settings['maxPoolSize']}"
+                )
+    return _client
+
+
+def set_client(client):
+    """Inject a client (e.g. mongomock.MongoClient() in tests), returns the old one"""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    return previous
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+
+def get_collection(db, collection):
+    return get_client()[db][collection]
+
+
+def ensure_index(collection, keys, **kwargs):
+    """create_index once per process for each (collection, keys) pair"""
+    key = (collection.database.name, collection.name, tuple(keys))
+    if key not in _ensured_indexes:
+        collection.create_index(keys, **kwargs)
+        _ensured_indexes.add(key)
+
+
+def upsert_many(collection, docs, key="_id"):
+    """Unordered bulk replace-or-insert of docs matched on `key`"""
+    if not docs:
+        return None
+    operations = [pymongo.ReplaceOne({key: doc[key]}, doc, upsert=True) for doc in docs]
+    return collection.bulk_write(operations, ordered=False)
+
+
+def insert_new(collection, docs, key="_id"):
+    """Unordered bulk insert of docs whose `key` is not stored yet, returns count"""
+    if not docs:
+        return 0
+    operations = [
+        pymongo.UpdateOne({key: doc[key]}, {"$setOnInsert": doc}, upsert=True)
+        for doc in docs
+    ]
+    result = collection.bulk_write(operations, ordered=False)
+    return result.upserted_count
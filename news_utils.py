@@ -1,94 +1,164 @@
+import hashlib
 import logging as log
-import os
 from datetime import datetime, time
-from time import sleep
 
-import bs4
 import pymongo
-import requests
-from newsapi import NewsApiClient
+
+import metrics
+from config_utils import get_config_path, load_key_text, load_text
+from mongo_utils import ensure_index, get_collection
 
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
 def get_news_api_key():
-    home = os.path.expanduser("~")
-    with open(f"{home}/keys/google-news-api/news_api_key", "r") as f:
-        news_api_key = f.read().rstrip("\n")
-    return news_api_key
+    return load_key_text("google-news-api", "news_api_key")
 
 
 def get_google_news_sources():
-    with open(f"./configs/google_news_sources", "r") as f:
-        sources = f.read().strip()
-    return sources
+    return load_text(get_config_path("google_news_sources"))
+
+
+def get_articles_collection():
+    """One document per article, unique on url"""
+    collection = get_collection("googlenews", "articleItems")
+    ensure_index(collection, [("url", pymongo.ASCENDING)], unique=True)
+    ensure_index(collection, [("publishedAt", pymongo.DESCENDING)])
+    return collection
+
+
+def get_news_checkpoint():
+    """publishedAt of the newest article ingested, None before the first run"""
+    doc = get_collection("googlenews", "checkpoints").find_one({"_id": "everything"})
+    if doc is None:
+        return None
+    return doc["publishedAt"]
+
+
+def save_news_checkpoint(published_at):
+    get_collection("googlenews", "checkpoints").update_one(
+        {"_id": "everything"},
+        {"$max": {"publishedAt": published_at}, "$set": {"updatedAt": datetime.now()}},
+        upsert=True,
+    )
 
 
 def get_google_news(sources, from_param=None):
+    """
+    NewsAPI /everything response. Error responses come back as their
+    {"status": "error", "code": ..., "message": ...} body rather than raising,
+    and a rateLimited one drains the newsapi quota.
+    """
+    from newsapi import NewsApiClient
+    from newsapi.newsapi_exception import NewsAPIException
+
+    import http_utils
+
     api_key = get_news_api_key()
-    client = NewsApiClient(api_key)
+    client = NewsApiClient(api_key, session=http_utils.get_session("newsapi"))
     if from_param is None:
         from_param = datetime.combine(datetime.today(), time.min).strftime(
             "%Y-%m-%dT%H:%M:%S"
         )
     try:
-        news = client.get_everything(
-            sources=sources, from_param=from_param, language="en"
-        )
-    except requests.exceptions.ReadTimeout as e:
-        log.warning(f"requests.exceptions.ReadTimeout - retrying after 5 minutes")
-        sleep(300)
-        news = client.get_everything(
-            sources=sources, from_param=from_param, language="en"
-        )
+        with metrics.timer("http_fetch", endpoint="newsapi"):
+            news = http_utils.call_with_retry(
+                "newsapi",
+                client.get_everything,
+                sources=sources,
+                from_param=from_param,
+                language="en",
+            )
+    except NewsAPIException as e:
+        # the client raises on any non-200, so a 429 never reaches call_with_retry
+        error = e.get_exception()
+        if error.get("code") == "rateLimited":
+            http_utils.get_quota("newsapi").drain()
+        return error
     now = datetime.now()
     news["_id"] = int(now.strftime("%Y%m%d%H%M"))
     return news
 
 
-def get_wiki_current_events():
+WIKI_CURRENT_EVENTS_URL = "https://en.m.wikipedia.org/wiki/Portal:Current_events"
+
+
+def get_wiki_http_cache_collection():
+    return get_collection("wiki", "httpCache")
+
+
+def get_wiki_validators(url=WIKI_CURRENT_EVENTS_URL):
+    """ETag/Last-Modified of the last successful fetch of url"""
+    doc = get_wiki_http_cache_collection().find_one({"_id": url})
+    if doc is None:
+        return {}
+    doc.pop("_id")
+    return doc
+
+
+def save_wiki_validators(validators, url=WIKI_CURRENT_EVENTS_URL):
+    get_wiki_http_cache_collection().replace_one(
+        filter={"_id": url}, replacement=validators, upsert=True
+    )
+
+
+def get_wiki_current_events(validators=None):
+    """
+    Conditional GET of the current events portal using the ETag/Last-Modified
+    in `validators`. Returns (current_events, validators), current_events is
+    None if the page is unchanged or has no section for today yet.
+    """
+    import bs4
+
+    import http_utils
+
     now = datetime.now()
     today_date = now.strftime("%Y_%B_%-d")
-    url = "https://en.m.wikipedia.org/wiki/Portal:Current_events"
-    r = requests.get(url)
-    soup = bs4.BeautifulSoup(r.content, "html.parser")
-    anchors = soup.find_all("a")
-    for anchor in anchors:
-        anchor.replace_with_children()
-    today_block = soup.find(id=today_date)
-    if today_block is None:
-        return None
-    else:
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    r = http_utils.get("wiki", WIKI_CURRENT_EVENTS_URL, headers=headers)
+    if r.status_code == 304:
+        log.info("Current events page not modified since last fetch")
+        return None, validators
+    r.raise_for_status()
+    validators = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+    }
+    with metrics.timer("parse", source="wiki"):
+        # only build a tree for today's block rather than the whole portal
+        strainer = bs4.SoupStrainer(id=today_date)
+        soup = bs4.BeautifulSoup(r.content, "html.parser", parse_only=strainer)
+        today_block = soup.find(id=today_date)
+        if today_block is None:
+            log.info("No section published for today's current events on wiki")
+            return None, validators
+        for anchor in today_block.find_all("a"):
+            anchor.replace_with_children()
         html = today_block.contents[-1].renderContents().decode()
-        return {
-            "_id": int(now.strftime("%Y%m%-d")),
-            "date": now.strftime("%-d %b %Y"),
-            "text": html,
-        }
+    return {
+        "_id": int(now.strftime("%Y%m%-d")),
+        "date": now.strftime("%-d %b %Y"),
+        "text": html,
+        "_hash": hashlib.sha256(html.encode()).hexdigest(),
+    }, validators
 
 
 def query_wiki_current_events(ts=None):
     if ts is None:
         ts = datetime.now()
     doc_id = int(str(ts.date()).replace("-", ""))
-    client = pymongo.MongoClient()
-    db = client["wiki"]
-    collection = db["currentEvents"]
+    collection = get_collection("wiki", "currentEvents")
     doc = collection.find_one({"_id": doc_id})
     return doc
 
 
 def query_news_articles(**config):
     count = config["articles"]
-    client = pymongo.MongoClient()
-    db = client["googlenews"]
-    collection = db["articles"]
-    docs = collection.find(sort=[("_id", -1)])
-    articles = []
-    for doc in docs:
-        doc_articles = doc["articles"]
-        for article in doc_articles:
-            articles.append(article)
-            count -= 1
-            if count == 0:
-                return articles
+    collection = get_articles_collection()
+    articles = collection.find(sort=[("publishedAt", -1)]).limit(count)
+    return list(articles)
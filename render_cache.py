@@ -0,0 +1,56 @@
+import logging as log
+import threading
+from collections import OrderedDict
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class RenderCache:
+    """
+    Bounded LRU cache of rendered HTML fragments. Keys are built from the
+    section name, the source documents' ids and the section parameters, so a
+    fragment is rendered once however many recipients share it.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, section, key, render, *args):
+        cache_key = (section, key)
+        with self._lock:
+            if cache_key in self._fragments:
+                self._fragments.move_to_end(cache_key)
+                self.hits += 1
+                return self._fragments[cache_key]
+            self.misses += 1
+        html = render(*args)
+        with self._lock:
+            self._fragments[cache_key] = html
+            self._fragments.move_to_end(cache_key)
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        log.info(f"{section} html body rendered")
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+render_cache = RenderCache()
+
+
+def doc_key(doc):
+    """Cache key part for a source document: its _id, else its url"""
+    if doc is None:
+        return None
+    return doc.get("_id", doc.get("url"))
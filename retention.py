@@ -0,0 +1,163 @@
+import logging as log
+import sys
+from datetime import datetime, timedelta
+
+import pymongo
+from bson import ObjectId
+
+import metrics
+from config_utils import load_config_json
+from mongo_utils import get_client, get_collection
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# documents written by the aggregator carry this date for TTL indexes
+INGESTED_AT = "_ingested_at"
+BATCH_SIZE = 1000
+
+
+def get_retention_policy(policy="retention.json"):
+    return load_config_json(policy)
+
+
+def apply_ttl_index(collection, days, field=INGESTED_AT):
+    """Create the TTL index on field, or change its expiry if it already exists"""
+    seconds = int(days * 24 * 3600)
+    for name, info in collection.index_information().items():
+        if info["key"] == [(field, 1)]:
+            if info.get("expireAfterSeconds") != seconds:
+                collection.database.command(
+                    "collMod",
+                    collection.name,
+                    index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds},
+                )
+                log.info(f"TTL on {collection.full_name} changed to {days} days")
+            return
+    collection.create_index([(field, pymongo.ASCENDING)], expireAfterSeconds=seconds)
+    log.info(f"TTL index of {days} days created on {collection.full_name}")
+
+
+def delete_ids(collection, ids):
+    deleted = 0
+    for i in range(0, len(ids), BATCH_SIZE):
+        result = collection.delete_many({"_id": {"$in": ids[i : i + BATCH_SIZE]}})
+        deleted += result.deleted_count
+    return deleted
+
+
+def compact_hourly_forecasts(max_age_days=None, keep_latest_per_area_per_day=True):
+    """
+    Drop raw forecast documents older than max_age_days, and all but the
+    newest forecast per area per day. Only _id and _area are read.
+    """
+    collection = get_collection("metoffice", "hourly")
+    deleted = 0
+    if max_age_days is not None:
+        cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=max_age_days))
+        deleted += collection.delete_many({"_id": {"$lt": cutoff}}).deleted_count
+    if keep_latest_per_area_per_day:
+        seen = set()
+        superseded = []
+        docs = collection.find(projection={"_area": 1}, sort=[("_id", -1)])
+        for doc in docs:
+            key = (doc.get("_area"), doc["_id"].generation_time.date())
+            if key in seen:
+                superseded.append(doc["_id"])
+            else:
+                seen.add(key)
+        deleted += delete_ids(collection, superseded)
+    log.info(f"{deleted} documents removed from {collection.full_name}")
+    return deleted
+
+
+def compact_timesteps():
+    """Keep only the newest issue of each (area, forecast time)"""
+    collection = get_collection("metoffice", "timesteps")
+    pipeline = [
+        {
+            "$group": {
+                "_id": {"_area": "$_area", "time": "$time"},
+                "latest": {"$max": "$modelRunDate"},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    operations = [
+        pymongo.DeleteMany(
+            {
+                "_area": group["_id"]["_area"],
+                "time": group["_id"]["time"],
+                "modelRunDate": {"$lt": group["latest"]},
+            }
+        )
+        for group in collection.aggregate(pipeline, allowDiskUse=True)
+    ]
+    deleted = 0
+    for i in range(0, len(operations), BATCH_SIZE):
+        result = collection.bulk_write(operations[i : i + BATCH_SIZE], ordered=False)
+        deleted += result.deleted_count
+    log.info(f"{deleted} superseded timesteps removed from {collection.full_name}")
+    return deleted
+
+
+def cap_collection(collection, max_docs):
+    """Keep the newest max_docs documents by _id"""
+    boundary = collection.find_one(
+        sort=[("_id", -1)], skip=max_docs - 1, projection={"_id": 1}
+    )
+    if boundary is None:
+        return 0
+    deleted = collection.delete_many({"_id": {"$lt": boundary["_id"]}}).deleted_count
+    log.info(f"{deleted} documents removed from {collection.full_name}")
+    return deleted
+
+
+def apply_retention(policy=None):
+    """Apply the retention policy to every collection, returns documents removed"""
+    if policy is None:
+        policy = get_retention_policy()
+    client = get_client()
+    removed = {}
+
+    metoffice = policy.get("metoffice", {})
+    with metrics.timer("retention", source="met-office"):
+        removed["metoffice.hourly"] = compact_hourly_forecasts(
+            metoffice.get("hourly_max_age_days"),
+            metoffice.get("hourly_keep_latest_per_area_per_day", False),
+        )
+        timesteps = get_collection("metoffice", "timesteps")
+        if "timesteps_ttl_days" in metoffice:
+            apply_ttl_index(timesteps, metoffice["timesteps_ttl_days"])
+        if metoffice.get("timesteps_keep_latest_issue"):
+            removed["metoffice.timesteps"] = compact_timesteps()
+
+    googlenews = policy.get("googlenews", {})
+    if "articles_ttl_days" in googlenews:
+        articles = get_collection("googlenews", "articleItems")
+        apply_ttl_index(articles, googlenews["articles_ttl_days"])
+
+    twitter = policy.get("twitter", {})
+    with metrics.timer("retention", source="twitter"):
+        for name in client["twitter"].list_collection_names():
+            collection = client["twitter"][name]
+            if "tweets_ttl_days" in twitter:
+                apply_ttl_index(collection, twitter["tweets_ttl_days"])
+            if "max_tweets_per_account" in twitter:
+                removed[f"twitter.{name}"] = cap_collection(
+                    collection, twitter["max_tweets_per_account"]
+                )
+
+    for name, count in removed.items():
+        metrics.inc("documents_removed_total", count, collection=name)
+    return removed
+
+
+if __name__ == "__main__":
+    """
+    python retention.py
+    python retention.py policy=retention.json
+    """
+    args = dict([arg.split("=") for arg in sys.argv[1:]])
+    apply_retention(get_retention_policy(**args))
+    metrics.export("retention")
@@ -0,0 +1,258 @@
+import heapq
+import itertools
+import logging as log
+import random
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+
+import http_utils
+import metrics
+from config_utils import load_config_json
+from data_aggregator import SOURCE_ENDPOINTS, upload
+from emailer import (
+    create_email_html_body,
+    get_config,
+    send_email,
+    send_emails,
+    warm_section_cache,
+)
+from retention import apply_retention
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# adaptive jobs poll this much faster after a run that found new data, and
+# this much slower after one that found nothing
+SPEED_UP = 2
+BACK_OFF = 1.5
+
+
+def get_schedule(schedule="schedule.json"):
+    return load_config_json(schedule)
+
+
+def next_daily_run(at, now=None):
+    """Next datetime at local wall clock time `at` ("HH:MM")"""
+    if now is None:
+        now = datetime.now()
+    hour, minute = (int(part) for part in at.split(":"))
+    run = datetime.combine(now.date(), time(hour, minute))
+    if run <= now:
+        run += timedelta(days=1)
+    return run
+
+
+def minutes_before(at, minutes):
+    """Wall clock time ("HH:MM") `minutes` before `at`, wrapping past midnight"""
+    hour, minute = (int(part) for part in at.split(":"))
+    earlier = datetime.combine(datetime.now().date(), time(hour, minute))
+    return (earlier - timedelta(minutes=minutes)).strftime("%H:%M")
+
+
+class Scheduler:
+    """
+    Runs jobs in one resident process so imports, the Mongo client and
+    config stay warm between runs. Interval jobs are rescheduled with a
+    random jitter, daily jobs fire at a fixed local time. Jobs run on a
+    thread pool so a slow source does not delay the others, and a job is
+    never run concurrently with itself. Interval jobs are rescheduled when
+    their run finishes, so the next run is timed from what this one found.
+
+    Interval jobs given a min and max interval adapt between them on what
+    their last run returned, and jobs tied to an http_utils endpoint wait
+    until its quota covers another run.
+    """
+
+    def __init__(self, max_workers=4):
+        self._queue = []
+        self._counter = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stop = threading.Event()
+        self._running = set()
+        self._lock = threading.Lock()
+        # guards the queue, reentrant so stop() can run from a signal handler
+        self._wakeup = threading.Condition(threading.RLock())
+
+    def _push(self, run_at, job):
+        with self._wakeup:
+            heapq.heappush(self._queue, (run_at, next(self._counter), job))
+            self._wakeup.notify()
+
+    def add_interval_job(
+        self,
+        name,
+        func,
+        interval,
+        jitter=0,
+        run_now=True,
+        min_interval=None,
+        max_interval=None,
+        endpoint=None,
+    ):
+        job = {
+            "name": name,
+            "func": func,
+            "interval": interval,
+            "jitter": jitter,
+            "min_interval": min_interval or interval,
+            "max_interval": max_interval or interval,
+            "endpoint": endpoint,
+            "calls_per_run": 1,
+        }
+        delay = 0 if run_now else interval
+        self._push(datetime.now() + timedelta(seconds=delay), job)
+
+    def add_daily_job(self, name, func, at):
+        job = {"name": name, "func": func, "at": at}
+        self._push(next_daily_run(at), job)
+
+    def _reschedule(self, job):
+        if "at" in job:
+            self._push(next_daily_run(job["at"]), job)
+        else:
+            delay = job["interval"] + random.uniform(-job["jitter"], job["jitter"])
+            quota = http_utils.get_quota(job["endpoint"])
+            if quota is not None:
+                wait = quota.seconds_until(job["calls_per_run"])
+                if wait > delay:
+                    log.info(f"{job['name']} waiting {wait:.0f}s for quota")
+                    delay = wait
+            self._push(datetime.now() + timedelta(seconds=max(delay, 0)), job)
+
+    @staticmethod
+    def _adapt(job, found_new):
+        """Shorten the interval of a job that found new data, lengthen it otherwise"""
+        if job["min_interval"] == job["max_interval"]:
+            return
+        if found_new:
+            interval = max(job["min_interval"], job["interval"] / SPEED_UP)
+        else:
+            interval = min(job["max_interval"], job["interval"] * BACK_OFF)
+        if interval != job["interval"]:
+            log.info(f"{job['name']} interval now {interval / 60:.1f} minutes")
+            job["interval"] = interval
+
+    def _run(self, job):
+        quota = http_utils.get_quota(job.get("endpoint"))
+        spent = quota.spent if quota is not None else 0
+        found_new = False
+        try:
+            log.info(f"running {job['name']}")
+            found_new = bool(job["func"]())
+        except Exception:
+            log.exception(f"{job['name']} failed")
+        finally:
+            if "interval" in job:
+                self._adapt(job, found_new)
+            if quota is not None:
+                job["calls_per_run"] = max(quota.spent - spent, 1)
+            # one step, so run_forever never sees neither queued nor running
+            with self._wakeup:
+                with self._lock:
+                    self._running.discard(job["name"])
+                if "interval" in job:
+                    self._reschedule(job)
+            metrics.export("scheduler")
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            with self._wakeup:
+                if not self._queue:
+                    with self._lock:
+                        if not self._running:
+                            break
+                    # an interval job in flight pushes itself back when done
+                    self._wakeup.wait()
+                    continue
+                run_at, _, job = self._queue[0]
+                wait = (run_at - datetime.now()).total_seconds()
+                if wait > 0:
+                    self._wakeup.wait(wait)
+                    continue
+                heapq.heappop(self._queue)
+            with self._lock:
+                already_running = job["name"] in self._running
+                if not already_running:
+                    self._running.add(job["name"])
+            if already_running:
+                log.info(f"{job['name']} still running, skipping this run")
+                self._reschedule(job)
+            else:
+                self._executor.submit(self._run, job)
+                if "at" in job:
+                    self._reschedule(job)
+        self._executor.shutdown(wait=True)
+        log.info("scheduler stopped")
+
+    def stop(self, *args):
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+
+def email_job(email):
+    if "recipients" in email:
+        return lambda: send_emails(get_config(email["recipients"]))
+    config_name = email["config"]
+    return lambda: send_email(
+        create_email_html_body(config_name, **get_config(config_name))
+    )
+
+
+def email_config_names(email):
+    if "recipients" in email:
+        recipients = get_config(email["recipients"])
+        return list(dict.fromkeys(recipient["config"] for recipient in recipients))
+    return [email["config"]]
+
+
+def build_scheduler(schedule):
+    scheduler = Scheduler()
+    for entry in schedule.get("sources", []):
+        kwargs = entry["upload"]
+        name = "upload " + " ".join(f"{k}={v}" for k, v in kwargs.items())
+        interval = entry["interval_minutes"] * 60
+        scheduler.add_interval_job(
+            name,
+            lambda kwargs=kwargs: upload(**kwargs),
+            interval=interval,
+            jitter=entry.get("jitter_seconds", 0),
+            min_interval=entry.get("min_interval_minutes", interval / 60) * 60,
+            max_interval=entry.get("max_interval_minutes", interval / 60) * 60,
+            endpoint=SOURCE_ENDPOINTS.get(kwargs["source"]),
+        )
+    if "retention" in schedule:
+        scheduler.add_interval_job(
+            "retention",
+            apply_retention,
+            interval=schedule["retention"]["interval_minutes"] * 60,
+            jitter=schedule["retention"].get("jitter_seconds", 0),
+            run_now=False,
+        )
+    for email in schedule.get("emails", []):
+        target = email.get("recipients", email.get("config"))
+        name = f"email {target} at {email['time']}"
+        scheduler.add_daily_job(name, email_job(email), email["time"])
+        if "warm_minutes_before" in email:
+            # fill the section cache so the send does not wait on Mongo
+            warm_at = minutes_before(email["time"], email["warm_minutes_before"])
+            scheduler.add_daily_job(
+                f"warm {target} at {warm_at}",
+                lambda email=email: warm_section_cache(email_config_names(email)),
+                warm_at,
+            )
+    return scheduler
+
+
+if __name__ == "__main__":
+    """
+    python scheduler.py
+    python scheduler.py schedule=schedule.json
+    """
+    args = dict([arg.split("=") for arg in sys.argv[1:]])
+    scheduler = build_scheduler(get_schedule(**args))
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run_forever()
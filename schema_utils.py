@@ -0,0 +1,136 @@
+import logging as log
+import sys
+from datetime import datetime
+
+import pymongo
+
+from mongo_utils import get_client, get_collection
+from news_utils import get_articles_collection
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+TWEET_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+ARTICLE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+BATCH_SIZE = 1000
+
+
+def parse_tweet_date(created_at):
+    """'Fri Jan 01 10:00:00 +0000 2021' as a naive UTC datetime, as pymongo returns"""
+    if isinstance(created_at, datetime):
+        return created_at
+    return datetime.strptime(created_at, TWEET_DATE_FORMAT).replace(tzinfo=None)
+
+
+def parse_article_date(published_at):
+    if isinstance(published_at, datetime):
+        return published_at
+    published_at = published_at.rstrip("Z").split(".")[0].split("+")[0]
+    return datetime.strptime(published_at, "%Y-%m-%dT%H:%M:%S")
+
+
+def slim_tweet(status_json):
+    """The fields the emailer reads, with created_at as a date"""
+    doc = {
+        "_id": status_json["_id"],
+        "created_at": parse_tweet_date(status_json["created_at"]),
+        "full_text": status_json.get("full_text", status_json.get("text")),
+    }
+    if "_ingested_at" in status_json:
+        doc["_ingested_at"] = status_json["_ingested_at"]
+    return doc
+
+
+def slim_article(article):
+    """url, title, source name and publishedAt as a date"""
+    source_info = article.get("source") or {}
+    if isinstance(source_info, dict):
+        # the API has used both "name" and "Name", and sends nulls for both
+        source = (
+            source_info.get("name") or source_info.get("Name") or source_info.get("id")
+        )
+    else:
+        source = source_info
+    source = source or ""
+    doc = {
+        "url": article["url"],
+        "title": article["title"],
+        "source": source,
+        "publishedAt": parse_article_date(article["publishedAt"]),
+    }
+    for key in ("_id", "_ingested_at"):
+        if key in article:
+            doc[key] = article[key]
+    return doc
+
+
+def _migrate_collection(collection, date_field, slim):
+    """Rewrite documents whose date_field is still a string in the compact schema"""
+    migrated = 0
+    operations = []
+    for doc in collection.find({date_field: {"$type": "string"}}):
+        operations.append(pymongo.ReplaceOne({"_id": doc["_id"]}, slim(doc)))
+        if len(operations) == BATCH_SIZE:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+    log.info(f"{migrated} documents migrated in {collection.full_name}")
+    return migrated
+
+
+def migrate_legacy_articles(drop=True):
+    """
+    Unwind the NewsAPI responses stored whole in googlenews.articles into one
+    articleItems document per article, seeding the news checkpoint on the way,
+    then drop the legacy collection. Returns articles written.
+    """
+    from backfill import BulkWriter, article_operations
+
+    legacy = get_collection("googlenews", "articles")
+    writer = BulkWriter()
+    try:
+        records = legacy.find(sort=[("_id", pymongo.ASCENDING)])
+        for collection, operation in article_operations(writer, records):
+            writer.add(collection, operation)
+    finally:
+        writer.close()
+    get_articles_collection()
+    log.info(f"{writer.written} articles moved out of {legacy.full_name}")
+    if drop:
+        legacy.drop()
+        log.info(f"{legacy.full_name} dropped")
+    return writer.written
+
+
+def migrate():
+    """One-off migration of stored tweets and articles to the compact schema"""
+    client = get_client()
+    migrated = {}
+    if "articles" in client["googlenews"].list_collection_names():
+        migrated["googlenews.articles"] = migrate_legacy_articles()
+    for name in client["twitter"].list_collection_names():
+        collection = client["twitter"][name]
+        migrated[collection.full_name] = _migrate_collection(
+            collection, "created_at", slim_tweet
+        )
+    articles = get_collection("googlenews", "articleItems")
+    migrated[articles.full_name] = _migrate_collection(
+        articles, "publishedAt", slim_article
+    )
+    checkpoints = get_collection("googlenews", "checkpoints")
+    for checkpoint in checkpoints.find({"publishedAt": {"$type": "string"}}):
+        checkpoints.update_one(
+            {"_id": checkpoint["_id"]},
+            {"$set": {"publishedAt": parse_article_date(checkpoint["publishedAt"])}},
+        )
+    return migrated
+
+
+if __name__ == "__main__":
+    """
+    python schema_utils.py migrate
+    """
+    if sys.argv[1:] == ["migrate"]:
+        migrate()
+    else:
+        raise ValueError("Usage: python schema_utils.py migrate")
@@ -0,0 +1,138 @@
+import logging as log
+import os
+import sqlite3
+import threading
+from datetime import date
+from time import time
+
+from bson import json_util
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+FRESH_FOR = 5 * 60
+SERVE_STALE_FOR = 6 * 60 * 60
+
+
+class SectionCache:
+    """
+    On-disk SQLite cache of the data each config's sections were last built
+    from, so an email can go out without waiting on MongoDB. Entries from
+    today younger than `fresh_for` seconds are served as they are, older ones
+    are served for up to `serve_stale_for` seconds while the caller refreshes
+    them in the background. Callers that cannot reach MongoDB can still ask for
+    the last good entry of any age. A broken cache file only ever counts as a
+    miss.
+    """
+
+    def __init__(self, path=None, fresh_for=FRESH_FOR, serve_stale_for=SERVE_STALE_FOR):
+        self.path = path
+        self.fresh_for = fresh_for
+        self.serve_stale_for = serve_stale_for
+        self._conn = None
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _connect(self):
+        if self._conn is None:
+            path = self.path
+            if path is None:
+                path = os.environ.get("SECTION_CACHE_PATH", "./cache/sections.db")
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sections (
+                    config_id TEXT,
+                    section TEXT,
+                    date TEXT,
+                    built_at REAL,
+                    data TEXT,
+                    PRIMARY KEY (config_id, section)
+                )
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, config_id, sections, any_age=False):
+        """
+        {section: (data, is_fresh)} for the usable cached sections, or with
+        any_age=True for every cached section however old
+        """
+        if not sections:
+            return {}
+        placeholders = ", ".join("?" * len(sections))
+        try:
+            with self._lock:
+                rows = (
+                    self._connect()
+                    .execute(
+                        "SELECT section, date, built_at, data FROM sections "
+                        f"WHERE config_id = ? AND section IN ({placeholders})",
+                        [config_id, *sections],
+                    )
+                    .fetchall()
+                )
+        except sqlite3.Error as e:
+            log.warning(f"section cache read failed: {e!r}")
+            return {}
+        now = time()
+        today = date.today().isoformat()
+        cached = {}
+        for section, day, built_at, data in rows:
+            age = now - built_at
+            if not any_age and (day != today or age > self.serve_stale_for):
+                continue
+            is_fresh = day == today and age <= self.fresh_for
+            cached[section] = (json_util.loads(data), is_fresh)
+        return cached
+
+    def put_many(self, config_id, sections_data):
+        if not sections_data:
+            return
+        now = time()
+        today = date.today().isoformat()
+        rows = [
+            (config_id, section, today, now, json_util.dumps(data))
+            for section, data in sections_data.items()
+        ]
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?, ?)", rows
+                    )
+        except sqlite3.Error as e:
+            log.warning(f"section cache write failed: {e!r}")
+
+    def claim_refresh(self, keys):
+        """The subset of keys not already being refreshed, now marked as refreshing"""
+        with self._lock:
+            claimed = [key for key in keys if key not in self._refreshing]
+            self._refreshing.update(claimed)
+        return claimed
+
+    def release_refresh(self, keys):
+        with self._lock:
+            self._refreshing.difference_update(keys)
+
+    def clear(self):
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute("DELETE FROM sections")
+        except sqlite3.Error as e:
+            log.warning(f"section cache clear failed: {e!r}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+section_cache = SectionCache()
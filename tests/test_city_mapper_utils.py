@@ -0,0 +1,11 @@
+from city_mapper_utils import get_journey
+
+
+def test_journey_mixes_whole_hours_and_clock_times():
+    weather = [{"home": "07:30"}, {"office": 18}, {"gym": 12}]
+    assert get_journey(weather=weather) == ("home", "office")
+
+
+def test_journey_orders_clock_times_by_minute():
+    weather = [{"office": "08:45"}, {"home": 8}, {"pub": "08:50"}]
+    assert get_journey(weather=weather) == ("home", "pub")
@@ -0,0 +1,150 @@
+import smtplib
+
+from pymongo.errors import ServerSelectionTimeoutError
+
+import emailer
+import metrics
+from digest_utils import digest_id
+from section_cache import SectionCache
+
+
+def test_batch_mixing_news_and_twitter_keeps_largest_article_count(monkeypatch):
+    calls = {}
+
+    def query_news_articles(articles):
+        calls["articles"] = articles
+        return [{"url": f"https://example.com/{i}"} for i in range(articles)]
+
+    def query_tweets(twitter):
+        calls.setdefault("tweet_counts", []).append(twitter["tweet_count"])
+        return [{"full_text": str(i)} for i in range(twitter["tweet_count"])]
+
+    monkeypatch.setattr(emailer, "query_news_articles", query_news_articles)
+    monkeypatch.setattr(emailer, "query_tweets", query_tweets)
+    configs = {
+        "a.json": {
+            "articles": 10,
+            "twitter": {"screen_name": "tweetthetube", "tweet_count": 3},
+        },
+        "b.json": {"articles": 4},
+    }
+    missing = {"a.json": ["news", "twitter"], "b.json": ["news"]}
+
+    results = emailer.run_queries(emailer.plan_queries(configs, missing))
+
+    assert calls == {"articles": 10, "tweet_counts": [3]}
+    assert len(emailer.section_data(configs["a.json"], "news", results)) == 10
+    assert len(emailer.section_data(configs["b.json"], "news", results)) == 4
+    assert len(emailer.section_data(configs["a.json"], "twitter", results)) == 3
+
+
+def use_section_cache(monkeypatch, tmp_path):
+    cache = SectionCache(path=str(tmp_path / "sections.db"))
+    monkeypatch.setattr(emailer, "section_cache", cache)
+    return cache
+
+
+def test_warmed_sections_are_served_without_querying(monkeypatch, tmp_path):
+    use_section_cache(monkeypatch, tmp_path)
+    config = {"articles": 2, "sections": ["news"]}
+    monkeypatch.setattr(emailer, "get_config", lambda config_name: config)
+    monkeypatch.setattr(emailer, "get_digest_sections", lambda config, sections: {})
+    monkeypatch.setattr(
+        emailer, "query_news_articles", lambda articles: [{"url": "a"}, {"url": "b"}]
+    )
+
+    assert emailer.warm_section_cache(["morning.json"]) == 1
+
+    def query_news_articles(articles):
+        raise AssertionError("news queried after the cache was warmed")
+
+    monkeypatch.setattr(emailer, "query_news_articles", query_news_articles)
+    data = emailer.get_sections_data({"morning.json": config})
+    assert data == {"morning.json": {"news": [{"url": "a"}, {"url": "b"}]}}
+
+
+def test_last_good_section_served_when_mongo_is_down(monkeypatch, tmp_path):
+    cache = use_section_cache(monkeypatch, tmp_path)
+    config = {"articles": 1, "sections": ["news", "current_events"]}
+    cache.put_many(digest_id(config), {"news": [{"url": "yesterday"}]})
+    # built yesterday, so past the date boundary of the normal lookup
+    with cache._connect() as conn:
+        conn.execute("UPDATE sections SET date = '2000-01-01', built_at = 0")
+
+    def unreachable(*args, **kwargs):
+        raise ServerSelectionTimeoutError("localhost:27017: connection refused")
+
+    monkeypatch.setattr(emailer, "get_digest_sections", unreachable)
+    monkeypatch.setattr(emailer, "query_news_articles", unreachable)
+    monkeypatch.setattr(emailer, "query_wiki_current_events", unreachable)
+
+    data = emailer.get_sections_data({"morning.json": config})
+
+    assert data == {"morning.json": {"news": [{"url": "yesterday"}]}}
+
+
+class FakeServer:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+        self.closed = False
+
+    def send_message(self, message, sender_email, receiver_email):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(receiver_email)
+
+    def close(self):
+        self.closed = True
+
+    quit = close
+
+
+def fake_sender(monkeypatch, servers):
+    monkeypatch.setattr(
+        emailer,
+        "get_email_credentials",
+        lambda: {"sender_email": "me@example.com", "receiver_email": "you@example.com"},
+    )
+    sender = emailer.EmailSender(use_ses=False)
+
+    def connect():
+        sender._server = servers.pop(0)
+        return sender._server
+
+    monkeypatch.setattr(sender, "connect", connect)
+    return sender
+
+
+def test_send_reconnects_when_the_server_closes_with_421(monkeypatch):
+    closing = FakeServer([smtplib.SMTPResponseException(421, b"Timeout, closing")])
+    fresh = FakeServer()
+    sender = fake_sender(monkeypatch, [closing, fresh])
+
+    sender.send("<html></html>", "someone@example.com")
+
+    assert closing.closed
+    assert fresh.sent == ["someone@example.com"]
+
+
+def test_send_emails_carries_on_past_a_refused_recipient(monkeypatch):
+    metrics.registry.reset()
+    refused = smtplib.SMTPRecipientsRefused({"bad@example.com": (550, b"no such user")})
+    server = FakeServer([refused])
+    monkeypatch.setattr(
+        emailer,
+        "create_email_html_bodies",
+        lambda configs: {name: "<html></html>" for name in configs},
+    )
+    monkeypatch.setattr(emailer, "get_config", lambda config_name: {})
+    recipients = [
+        {"receiver_email": "bad@example.com", "config": "morning.json"},
+        {"receiver_email": "good@example.com", "config": "morning.json"},
+    ]
+
+    emailer.send_emails(
+        recipients, sender_class=lambda use_ses: fake_sender(monkeypatch, [server])
+    )
+
+    assert server.sent == ["good@example.com"]
+    assert metrics.registry.counters[("emails_failed_total", ())] == 1
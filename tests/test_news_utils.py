@@ -0,0 +1,26 @@
+from newsapi import NewsApiClient
+from newsapi.newsapi_exception import NewsAPIException
+
+import http_utils
+import news_utils
+
+
+def test_rate_limited_response_drains_newsapi_quota(monkeypatch):
+    error = {
+        "status": "error",
+        "code": "rateLimited",
+        "message": "You have made too many requests recently.",
+    }
+
+    def get_everything(self, **kwargs):
+        raise NewsAPIException(error)
+
+    monkeypatch.setattr(news_utils, "get_news_api_key", lambda: "key")
+    monkeypatch.setattr(NewsApiClient, "get_everything", get_everything)
+    quota = http_utils.get_quota("newsapi")
+    assert quota.seconds_until(1) == 0
+
+    news = news_utils.get_google_news(sources="bbc-news")
+
+    assert news == error
+    assert quota.seconds_until(1) > 0
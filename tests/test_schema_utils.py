@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+
+import mongo_utils
+import schema_utils
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def client():
+    client = mongomock.MongoClient()
+    previous = mongo_utils.set_client(client)
+    yield client
+    mongo_utils.set_client(previous)
+
+
+def article(url, published_at):
+    return {
+        "source": {"id": None, "name": "BBC News"},
+        "title": url,
+        "url": url,
+        "publishedAt": published_at,
+    }
+
+
+def test_legacy_articles_unwound_into_article_items(client):
+    client["googlenews"]["articleItems"].insert_one(
+        {"url": "https://a", "title": "a", "publishedAt": datetime(2021, 3, 1, 8)}
+    )
+    client["googlenews"]["articles"].insert_many(
+        [
+            {
+                "_id": 202103010900,
+                "status": "ok",
+                "articles": [
+                    article("https://a", "2021-03-01T08:00:00Z"),
+                    article("https://b", "2021-03-01T08:30:00Z"),
+                ],
+            },
+            {
+                "_id": 202103011200,
+                "status": "ok",
+                "articles": [
+                    article("https://b", "2021-03-01T08:30:00Z"),
+                    article("https://c", "2021-03-01T11:45:00Z"),
+                ],
+            },
+        ]
+    )
+
+    migrated = schema_utils.migrate()
+
+    assert migrated["googlenews.articles"] == 2
+    items = client["googlenews"]["articleItems"]
+    assert sorted(items.distinct("url")) == ["https://a", "https://b", "https://c"]
+    assert items.find_one({"url": "https://c"})["source"] == "BBC News"
+    checkpoint = client["googlenews"]["checkpoints"].find_one({"_id": "everything"})
+    assert checkpoint["publishedAt"] == datetime(2021, 3, 1, 11, 45)
+    assert "articles" not in client["googlenews"].list_collection_names()
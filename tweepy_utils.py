@@ -1,27 +1,21 @@
-import os
-
-import pymongo
 from tweepy import API, OAuthHandler
 
+import http_utils
+from config_utils import load_key_text
+from mongo_utils import get_collection
+from schema_utils import slim_tweet
+
 
 class TweetGetter(API, OAuthHandler):
     @staticmethod
     def _get_tweepy_auth():
-        home = os.path.expanduser("~")
-        with open(f"{home}/keys/twitter/twitter_key", "r") as f:
-            twitter_key = f.read().rstrip("\n")
-        with open(f"{home}/keys/twitter/twitter_secret_key", "r") as f:
-            twitter_secret_key = f.read().rstrip("\n")
-        with open(f"{home}/keys/twitter/twitter_access_token", "r") as f:
-            twitter_access_token = f.read().rstrip("\n")
-        with open(f"{home}/keys/twitter/twitter_secret_access_token", "r") as f:
-            twitter_secret_access_token = f.read().rstrip("\n")
-        return {
-            "twitter_key": twitter_key,
-            "twitter_secret_key": twitter_secret_key,
-            "twitter_access_token": twitter_access_token,
-            "twitter_secret_access_token": twitter_secret_access_token,
-        }
+        names = [
+            "twitter_key",
+            "twitter_secret_key",
+            "twitter_access_token",
+            "twitter_secret_access_token",
+        ]
+        return {name: load_key_text("twitter", name) for name in names}
 
     @staticmethod
     def set_tweepy_account(credentials):
@@ -37,7 +31,16 @@ class TweetGetter(API, OAuthHandler):
     def __init__(self):
         self._credentials = TweetGetter._get_tweepy_auth()
         self._auth = TweetGetter.set_tweepy_account(self._credentials)
-        self.api = API(self._auth)
+        settings = http_utils.ENDPOINTS["twitter"]
+        self.api = API(
+            self._auth,
+            retry_count=settings["max_attempts"] - 1,
+            retry_delay=5,
+            retry_errors=http_utils.RETRY_STATUSES,
+            timeout=settings["timeout"][1],
+        )
+        # share the pooled keep-alive session with the rest of the http layer
+        self.api.session = http_utils.get_session("twitter")
 
     @staticmethod
     def _id_cleaner(ts):
@@ -49,22 +52,19 @@ class TweetGetter(API, OAuthHandler):
 
     @staticmethod
     def clean_status_object(status):
-        status_json = status._json
+        return TweetGetter.clean_status_json(status._json)
+
+    @staticmethod
+    def clean_status_json(status_json):
+        status_json = dict(status_json)
         status_json["_id"] = TweetGetter._id_cleaner(status_json.pop("id"))
-        for key in "id_str truncated display_text_range user".split():
-            try:
-                status_json.pop(key)
-            except KeyError:
-                continue
-        return status_json
+        return slim_tweet(status_json)
 
 
 def query_tweets(**config):
-    client = pymongo.MongoClient()
     screen_name = config["twitter"]["screen_name"]
     count = config["twitter"].get("tweet_count", 5)
-    db = client["twitter"]
-    collection = db[screen_name]
+    collection = get_collection("twitter", screen_name)
     tweets = collection.find(
         sort=[("_id", -1)], projection={"created_at": 1, "full_text": 1}
     ).limit(count)